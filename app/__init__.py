@@ -2,11 +2,11 @@ import os
 
 from flask import Flask
 from flask_cors import CORS
-from flask_sqlalchemy import SQLAlchemy
 
 from .config import config
+from .routing import RoutingSQLAlchemy
 
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
 
 
 def create_app(config_name):
@@ -15,7 +15,27 @@ def create_app(config_name):
     db.init_app(app)
     CORS(app)
 
+    from . import (access_log, admission, compression, graph, jobs, queries,
+                   routing, stats)
+    # after_request handlers run in reverse, registered first runs last
+    access_log.init_app(app)
+    compression.init_app(app)
+    admission.init_app(app)
+    routing.init_app(app)
+    queries.init_app(app)
+    graph.init_app(app)
+    jobs.init_app(app)
+    stats.init_app(app)
+
     from .api import api as api_blueprint
     app.register_blueprint(api_blueprint, url_prefix='/api/v1')
 
     return app
+
+
+def dispose_engines(app):
+    """Drops the pooled connections a forked worker inherited"""
+    with app.app_context():
+        db.engine.dispose()
+
+    app.extensions['replicas'].dispose()
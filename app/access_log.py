@@ -0,0 +1,189 @@
+import copy
+import logging
+import queue
+import random
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+from flask import current_app, has_request_context, json, request
+from flask.logging import default_handler
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# client and server errors are always written, whatever the sampling rate
+# of the route
+ERROR_STATUS = 400
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, with the `fields` of the record merged in"""
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc)
+            .isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage()
+        }
+        entry.update(getattr(record, 'fields', {}))
+
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+
+        return json.dumps(entry)
+
+
+class DroppingQueueHandler(QueueHandler):
+    """Hands records to a writer thread and never blocks the caller.
+
+    Records beyond the queue size are dropped and counted. The thread is
+    started with the first record, after the server forked.
+    """
+
+    def __init__(self, size, target):
+        super().__init__(queue.Queue(size))
+        self.listener = QueueListener(self.queue, target)
+        self.started = False
+        self.start_lock = threading.Lock()
+        self.dropped = 0
+
+    def prepare(self, record):
+        # the queue stays in this process, so the traceback is formatted by
+        # the listener thread instead of the request
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+
+        # errors logged inside a request carry its route and subject
+        if has_request_context() and not hasattr(record, 'fields'):
+            record.fields = request_fields()
+
+        return record
+
+    def enqueue(self, record):
+        if not self.started:
+            self.start()
+
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def start(self):
+        with self.start_lock:
+            if not self.started:
+                self.listener.start()
+                self.started = True
+
+    def close(self):
+        # called by logging.shutdown at exit, writes what is still queued
+        with self.start_lock:
+            if self.started:
+                self.listener.stop()
+                self.started = False
+
+        super().close()
+
+
+def request_fields():
+    rule = request.url_rule
+
+    return {
+        'method': request.method,
+        'route': rule.rule if rule is not None else request.path,
+        'subject': request.environ.get('casting.subject')
+    }
+
+
+def count_query(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context():
+        environ = request.environ
+        environ['casting.queries'] = environ.get('casting.queries', 0) + 1
+
+
+class AccessLog:
+    """Structured access and error log written by a background thread.
+
+    Requests and the errors of `app.logger` are put on a bounded queue and
+    formatted and written by a QueueListener, so a request never waits for
+    the disk. Successful requests are sampled per endpoint with
+    ACCESS_LOG_SAMPLING, errors and requests slower than ACCESS_LOG_SLOW_MS
+    are always written.
+    """
+
+    def __init__(self, app):
+        config = app.config
+        self.sample_rate = config['ACCESS_LOG_SAMPLE_RATE']
+        self.sampling = config['ACCESS_LOG_SAMPLING']
+        self.slow = config['ACCESS_LOG_SLOW_MS']
+
+        if config['ACCESS_LOG_FILE']:
+            target = logging.FileHandler(config['ACCESS_LOG_FILE'],
+                                         delay=True)
+        else:
+            target = logging.StreamHandler(sys.stdout)
+
+        target.setFormatter(JsonFormatter())
+        self.handler = DroppingQueueHandler(config['ACCESS_LOG_QUEUE_SIZE'],
+                                            target)
+
+        # app.logger is shared by every app created from this package
+        for handler in list(app.logger.handlers):
+            if handler is default_handler or \
+                    isinstance(handler, DroppingQueueHandler):
+                app.logger.removeHandler(handler)
+
+        app.logger.addHandler(self.handler)
+
+    def sampled(self, endpoint, status, latency):
+        if status >= ERROR_STATUS or latency >= self.slow:
+            return 1
+
+        rate = self.sampling.get(endpoint, self.sample_rate)
+
+        return rate if random.random() < rate else None
+
+    def log(self, fields, endpoint, status, latency, queries=None):
+        rate = self.sampled(endpoint, status, latency)
+
+        if rate is None:
+            return
+
+        record = logging.LogRecord('casting.access', logging.INFO, __file__,
+                                   0, 'request', None, None)
+        record.fields = dict(fields, status=status,
+                             latency_ms=round(latency, 2), queries=queries,
+                             sample_rate=rate)
+        self.handler.handle(record)
+
+
+def start_timer():
+    request.environ['casting.started'] = time.perf_counter()
+
+
+def log_request(response):
+    started = request.environ.get('casting.started')
+
+    if started is not None:
+        current_app.extensions['access_log'].log(
+            request_fields(), request.endpoint, response.status_code,
+            (time.perf_counter() - started) * 1000,
+            request.environ.get('casting.queries', 0))
+
+    return response
+
+
+def init_app(app):
+    if not app.config['ACCESS_LOG_ENABLED']:
+        return
+
+    if not event.contains(Engine, 'before_cursor_execute', count_query):
+        event.listen(Engine, 'before_cursor_execute', count_query)
+
+    app.extensions['access_log'] = AccessLog(app)
+    app.before_request(start_timer)
+    app.after_request(log_request)
@@ -0,0 +1,143 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app, request
+
+READ_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS'])
+
+# long-lived responses, limited apart so they can't starve the reads
+STREAM_ENDPOINTS = frozenset(['api.stream_changes_events'])
+
+# AdmissionError Exception
+
+
+class AdmissionError(Exception):
+    '''A standardized way to communicate rejected requests'''
+
+    def __init__(self, error, status_code, retry_after):
+        self.error = error
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """Refills `rate` tokens per second up to `burst` tokens"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def consume(self):
+        """Takes a token and returns 0, or the seconds until one is free"""
+        now = time.monotonic()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+
+        return (1 - self.tokens) / self.rate
+
+
+class Admission:
+    """Per-worker concurrency limits and per-subject rate limits"""
+
+    def __init__(self, config):
+        self.retry_after = config['ADMISSION_RETRY_AFTER']
+        self.queue_timeout = config['ADMISSION_QUEUE_TIMEOUT']
+        self.rate = config['ADMISSION_SUBJECT_RATE']
+        self.burst = config['ADMISSION_SUBJECT_BURST']
+        self.max_subjects = config['ADMISSION_MAX_SUBJECTS']
+        self.slots = {
+            'read': threading.BoundedSemaphore(
+                config['ADMISSION_READ_CONCURRENCY']),
+            'write': threading.BoundedSemaphore(
+                config['ADMISSION_WRITE_CONCURRENCY']),
+            'stream': threading.BoundedSemaphore(
+                config['ADMISSION_STREAM_CONCURRENCY'])
+        }
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def acquire(self, route_class):
+        if not self.slots[route_class].acquire(timeout=self.queue_timeout):
+            raise AdmissionError({
+                'code': 'overloaded',
+                'description': 'Service is overloaded, please retry later'
+            }, 503, self.retry_after)
+
+    def release(self, route_class):
+        self.slots[route_class].release()
+
+    def limit(self, subject):
+        with self.lock:
+            bucket = self.buckets.pop(subject, None)
+
+            if bucket is None:
+                bucket = TokenBucket(self.rate, self.burst)
+
+            self.buckets[subject] = bucket
+
+            if len(self.buckets) > self.max_subjects:
+                self.buckets.popitem(last=False)
+
+            wait = bucket.consume()
+
+        if wait:
+            raise AdmissionError({
+                'code': 'rate_limited',
+                'description': 'Too many requests'
+            }, 429, math.ceil(wait))
+
+
+def route_class(method, endpoint=None):
+    if endpoint in STREAM_ENDPOINTS:
+        return 'stream'
+
+    return 'read' if method in READ_METHODS else 'write'
+
+
+def acquire_slot():
+    # unmatched urls are rejected by routing anyway, don't spend a slot
+    if request.url_rule is None:
+        return
+
+    admission = current_app.extensions['admission']
+    slot = route_class(request.method, request.endpoint)
+    admission.acquire(slot)
+    # preserved request contexts can be torn down under another app
+    request.environ['casting.admission_slot'] = (admission, slot)
+
+
+def release_slot(exc):
+    acquired = request.environ.pop('casting.admission_slot', None)
+
+    if acquired is not None:
+        admission, slot = acquired
+        admission.release(slot)
+
+
+def limit_subject(payload):
+    """Applies the subject's token bucket once the JWT has been verified"""
+    admission = current_app.extensions.get('admission')
+    subject = payload.get('sub')
+
+    if admission is None or subject is None:
+        return
+
+    admission.limit(subject)
+
+
+def init_app(app):
+    if not app.config['ADMISSION_ENABLED']:
+        return
+
+    app.extensions['admission'] = Admission(app.config)
+    app.before_request(acquire_slot)
+    app.teardown_request(release_slot)
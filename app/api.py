@@ -1,8 +1,20 @@
-from datetime import datetime
-from flask import Blueprint, abort, jsonify, request, current_app
-
-from .auth import AuthError, requires_auth
-from .models import Movie, Actor
+import json
+import os
+from flask import (Blueprint, Response, abort, jsonify, request, current_app,
+                   send_file, stream_with_context)
+from sqlalchemy.orm.exc import StaleDataError
+
+from app import db, queries
+from .admission import AdmissionError
+from .auth import AuthError, requires_auth, check_permissions
+from .changes import changes_since, stream_changes
+from .counts import COUNT_MODES, count_rows
+from .export import FORMATS, export_chunks
+from .graph import costars, degrees_of_separation
+from .jobs import OPERATIONS
+from .models import Movie, Actor, Job, delete_rows
+from .schemas import ACTOR, IDS, MOVIE, ValidationError
+from .stats import get_stats
 
 api = Blueprint('api', __name__)
 
@@ -13,45 +25,115 @@ def index():
     return jsonify(msg)
 
 
+def paginate(model):
+    """Returns the requested page of `model` and the total row count"""
+    page = request.args.get('page', None, type=int)
+    per_page = request.args.get('per_page', current_app.config['PAGE_SIZE'],
+                                type=int)
+    count = request.args.get('count', current_app.config['COUNT_DEFAULT'])
+
+    if count not in COUNT_MODES:
+        abort(400)
+
+    if page is None:
+        items = queries.listing(model)
+        return items, None if count == 'none' else len(items)
+
+    if page < 1 or per_page < 1:
+        abort(400)
+
+    per_page = min(per_page, current_app.config['MAX_PAGE_SIZE'])
+    items = queries.listing(model, (page - 1) * per_page, per_page)
+
+    return items, count_rows(model, count)
+
+
+def collection(name, items, total):
+    response = {
+        "success": True,
+        name: [item.format() for item in items]
+    }
+
+    if total is not None:
+        response["total"] = total
+
+    return jsonify(response)
+
+
+def check_version(resource):
+    """Rejects the request unless If-Match names the current version"""
+    if request.if_match and \
+            not request.if_match.contains(str(resource.version)):
+        abort(412)
+
+
+def versioned(response, resource):
+    response.set_etag(str(resource.version))
+    return response
+
+
+def validated(schema):
+    """Returns the request body converted by `schema`, see app/schemas.py"""
+    body = request.get_json()
+
+    if not isinstance(body, dict):
+        abort(400)
+
+    return schema.validate(body)
+
+
+def delete_many(model):
+    """Deletes the ids listed in the body with a few set-based statements"""
+    ids = validated(IDS)['ids']
+    limit = current_app.config['MAX_DELETE_IDS']
+
+    if len(ids) > limit:
+        raise ValidationError(
+            {'ids': f'At most {limit} ids, delete more with a job'})
+
+    try:
+        deleted = delete_rows(model, ids)
+        db.session.commit()
+    except Exception as e:
+        current_app.logger.error(e)
+        abort(422)
+
+    if not deleted:
+        abort(404)
+
+    return jsonify({
+        "success": True,
+        "deleted": deleted
+    })
+
+
 @api.route('/movies', methods=["GET"])
 @requires_auth('get:movies')
 def get_movies(payload):
-    movies = Movie.query.order_by(Movie.id).all()
+    movies, total = paginate(Movie)
 
     if len(movies) == 0:
         abort(404)
 
-    return jsonify({
-        "success": True,
-        "movies": [movie.format() for movie in movies]
-    })
+    return collection("movies", movies, total)
 
 
 @api.route('/movies', methods=["POST"])
 @requires_auth('post:movies')
 def post_movies(payload):
-    body = request.get_json()
-
-    if body is None:
-        abort(400)
-
-    title = body.get('title', None)
-    release_date = body.get('release_date', None)
-    actors = body.get('actors', None)
+    data = validated(MOVIE)
 
     try:
-        movie = Movie(title=title, release_date=datetime.strptime(
-            release_date, '%Y-%m-%d'))
-
-        if actors:
-            movie.actors = Actor.query.filter(Actor.id.in_(actors)).all()
+        movie = Movie(title=data['title'],
+                      release_date=data.get('release_date', None),
+                      actors=data.get('actors', []))
 
         movie.insert()
 
-        return jsonify({
+        return versioned(jsonify({
             "success": True,
             "movie": movie.format()
-        })
+        }), movie)
     except Exception as e:
         current_app.logger.error(e)
         abort(422)
@@ -60,36 +142,31 @@ def post_movies(payload):
 @api.route('/movies/<int:movie_id>', methods=["PATCH"])
 @requires_auth('patch:movies')
 def patch_movies(payload, movie_id):
-    body = request.get_json()
-
-    if body is None:
-        abort(400)
-
-    movie = Movie.query.get(movie_id)
-
-    title = body.get('title', None)
-    release_date = body.get('release_date', None)
-    actors = body.get('actors', None)
+    data = validated(MOVIE)
+    movie = queries.get(Movie, movie_id)
 
     if movie is None:
         abort(404)
 
+    check_version(movie)
+
     try:
-        movie.title = title
+        movie.title = data['title']
 
-        if release_date:
-            movie.release_date = datetime.strptime(
-                release_date, '%Y-%m-%d')
+        if 'release_date' in data:
+            movie.release_date = data['release_date']
 
-        if actors:
-            movie.actors = Actor.query.filter(Actor.id.in_(actors)).all()
+        if data.get('actors', None):
+            movie.actors = data['actors']
 
         movie.update()
 
-        return jsonify({
+        return versioned(jsonify({
             "success": True,
             "movie": movie.format()
-        })
+        }), movie)
+    except StaleDataError:
+        abort(412)
     except Exception as e:
         current_app.logger.error(e)
         abort(422)
@@ -98,60 +175,62 @@ def patch_movies(payload, movie_id):
 @api.route('/movies/<int:movie_id>', methods=["DELETE"])
 @requires_auth('delete:movies')
 def delete_movie(payload, movie_id):
-    movie = Movie.query.get(movie_id)
+    movie = queries.get(Movie, movie_id)
 
     if movie is None:
         abort(404)
 
-    try:
-        movie.delete()
-
-        movies = Movie.query.order_by(Movie.id).all()
+    check_version(movie)
 
-        return jsonify({
-            "success": True,
-            "deleted": movie_id
-        })
+    try:
+        deleted = delete_rows(Movie, [movie_id], movie.version)
+        db.session.commit()
     except Exception as e:
         current_app.logger.error(e)
         abort(422)
 
+    # changed or deleted by another request since it was read
+    if not deleted:
+        abort(412)
+
+    return jsonify({
+        "success": True,
+        "deleted": movie_id
+    })
+
+
+@api.route('/movies', methods=["DELETE"])
+@requires_auth('delete:movies')
+def delete_movies(payload):
+    return delete_many(Movie)
+
 
 @api.route('/actors')
 @requires_auth('get:actors')
 def get_actors(payload):
-    actors = Actor.query.order_by(Actor.id).all()
+    actors, total = paginate(Actor)
 
     if actors == []:
         abort(404)
 
-    return jsonify({
-        "success": True,
-        "actors": [actor.format() for actor in actors]
-    })
+    return collection("actors", actors, total)
 
 
 @api.route('/actors', methods=["POST"])
 @requires_auth('post:actors')
 def create_actor(payload):
-    body = request.get_json()
-
-    if body is None:
-        abort(400)
-
-    name = body.get('name', None)
-    gender = body.get('gender', None)
-    age = body.get('age', None)
+    data = validated(ACTOR)
 
     try:
-        actor = Actor(name=name, gender=gender, age=age)
+        actor = Actor(name=data['name'], gender=data.get('gender', None),
+                      age=data.get('age', None))
 
         actor.insert()
 
-        return jsonify({
+        return versioned(jsonify({
             "success": True,
             "actor": actor.format()
-        })
+        }), actor)
     except Exception as e:
         current_app.logger.error(e)
         abort(422)
@@ -160,24 +239,27 @@ def create_actor(payload):
 @api.route('/actors/<int:actor_id>', methods=["PATCH"])
 @requires_auth('patch:actors')
 def edit_actor(payload, actor_id):
-    actor = Actor.query.get(actor_id)
+    data = validated(ACTOR)
+    actor = queries.get(Actor, actor_id)
 
     if actor is None:
         abort(404)
 
-    body = request.get_json()
+    check_version(actor)
 
     try:
-        actor.name = body.get('name', None)
-        actor.gender = body.get('gender', None)
-        actor.age = body.get('age', None)
+        actor.name = data['name']
+        actor.gender = data.get('gender', None)
+        actor.age = data.get('age', None)
 
         actor.update()
 
-        return jsonify({
+        return versioned(jsonify({
             "success": True,
             "actor": actor.format()
-        })
+        }), actor)
+    except StaleDataError:
+        abort(412)
     except Exception as e:
         current_app.logger.error(e)
         abort(422)
@@ -186,24 +268,304 @@ def edit_actor(payload, actor_id):
 @api.route('/actors/<int:actor_id>', methods=["DELETE"])
 @requires_auth('delete:actors')
 def delete_actor(payload, actor_id):
-    actor = Actor.query.get(actor_id)
+    actor = queries.get(Actor, actor_id)
 
     if actor is None:
         abort(404)
 
-    try:
-        actor.delete()
-
-        actors = Actor.query.order_by(Actor.id).all()
+    check_version(actor)
 
-        return jsonify({
-            "success": True,
-            "deleted": actor_id
-        })
+    try:
+        deleted = delete_rows(Actor, [actor_id], actor.version)
+        db.session.commit()
     except Exception as e:
         current_app.logger.error(e)
         abort(422)
 
+    # changed or deleted by another request since it was read
+    if not deleted:
+        abort(412)
+
+    return jsonify({
+        "success": True,
+        "deleted": actor_id
+    })
+
+
+@api.route('/actors', methods=["DELETE"])
+@requires_auth('delete:actors')
+def delete_actors(payload):
+    return delete_many(Actor)
+
+
+@api.route('/stats')
+@requires_auth('get:movies')
+def get_catalog_stats(payload):
+    check_permissions('get:actors', payload)
+
+    return jsonify({
+        "success": True,
+        "stats": get_stats()
+    })
+
+
+@api.route('/actors/<int:actor_id>/costars')
+@requires_auth('get:actors')
+def get_costars(payload, actor_id):
+    if queries.get(Actor, actor_id) is None:
+        abort(404)
+
+    return jsonify({
+        "success": True,
+        "actor": actor_id,
+        "costars": costars(actor_id)
+    })
+
+
+@api.route('/actors/<int:source_id>/path/<int:target_id>')
+@requires_auth('get:actors')
+def get_actor_path(payload, source_id, target_id):
+    ids = {source_id, target_id}
+
+    if len(queries.by_ids(Actor, ids)) != len(ids):
+        abort(404)
+
+    found = degrees_of_separation(source_id, target_id)
+
+    if found is None:
+        abort(404)
+
+    actors, movies = found
+
+    return jsonify({
+        "success": True,
+        "path": actors,
+        "movies": movies,
+        "degrees": len(movies)
+    })
+
+
+def export_response(resource):
+    fmt = request.args.get('format', 'csv')
+
+    if fmt not in FORMATS:
+        abort(400)
+
+    chunks = export_chunks(resource, fmt)
+
+    return Response(stream_with_context(chunks), mimetype=FORMATS[fmt],
+                    headers={'Content-Disposition':
+                             f'attachment; filename={resource}.{fmt}'})
+
+
+@api.route('/export/movies')
+@requires_auth('get:movies')
+def export_movies(payload):
+    return export_response('movies')
+
+
+@api.route('/export/actors')
+@requires_auth('get:actors')
+def export_actors(payload):
+    return export_response('actors')
+
+
+def job_params(operation, body):
+    if operation == 'import':
+        items = body.get('items', None)
+
+        if not isinstance(items, list) or \
+                not all(isinstance(item, dict) for item in items):
+            abort(422)
+
+        return {'items': items}, len(items)
+
+    if operation == 'delete':
+        ids = body.get('ids', None)
+
+        if not isinstance(ids, list) or \
+                not all(isinstance(i, int) for i in ids):
+            abort(422)
+
+        return {'ids': ids}, len(ids)
+
+    fmt = body.get('format', 'csv')
+
+    if fmt not in FORMATS:
+        abort(422)
+
+    return {'format': fmt}, None
+
+
+def submit_job(payload, resource):
+    body = request.get_json()
+
+    if body is None:
+        abort(400)
+
+    operation = body.get('operation', None)
+
+    if operation not in OPERATIONS:
+        abort(422)
+
+    check_permissions(f'{OPERATIONS[operation]}:{resource}', payload)
+    params, total = job_params(operation, body)
+
+    job = Job(resource=resource, operation=operation,
+              params=json.dumps(params), total=total)
+    job.insert()
+
+    current_app.extensions['jobs'].submit(job.id)
+
+    return jsonify({
+        "success": True,
+        "job": job.format()
+    }), 202
+
+
+def find_job(resource, job_id):
+    job = Job.query.filter_by(id=job_id, resource=resource).first()
+
+    if job is None:
+        abort(404)
+
+    return job
+
+
+def get_job(resource, job_id):
+    return jsonify({
+        "success": True,
+        "job": find_job(resource, job_id).format()
+    })
+
+
+def cancel_job(payload, resource, job_id):
+    job = find_job(resource, job_id)
+    check_permissions(f'{OPERATIONS[job.operation]}:{resource}', payload)
+
+    if not current_app.extensions['jobs'].cancel(job):
+        abort(422)
+
+    db.session.refresh(job)
+
+    return jsonify({
+        "success": True,
+        "job": job.format()
+    })
+
+
+def get_job_result(resource, job_id):
+    job = find_job(resource, job_id)
+
+    if job.operation != 'export' or job.status != 'succeeded':
+        abort(404)
+
+    result = json.loads(job.result)
+
+    # the file is gone once JOBS_EXPORT_RETENTION has passed
+    if not os.path.isfile(result['path']):
+        abort(404)
+
+    return send_file(result['path'], mimetype=FORMATS[result['format']],
+                     as_attachment=True,
+                     attachment_filename=f'{resource}.{result["format"]}')
+
+
+@api.route('/movies/jobs', methods=["POST"])
+@requires_auth('get:movies')
+def submit_movie_job(payload):
+    return submit_job(payload, 'movies')
+
+
+@api.route('/movies/jobs/<int:job_id>')
+@requires_auth('get:movies')
+def get_movie_job(payload, job_id):
+    return get_job('movies', job_id)
+
+
+@api.route('/movies/jobs/<int:job_id>', methods=["DELETE"])
+@requires_auth('get:movies')
+def cancel_movie_job(payload, job_id):
+    return cancel_job(payload, 'movies', job_id)
+
+
+@api.route('/movies/jobs/<int:job_id>/result')
+@requires_auth('get:movies')
+def get_movie_job_result(payload, job_id):
+    return get_job_result('movies', job_id)
+
+
+@api.route('/actors/jobs', methods=["POST"])
+@requires_auth('get:actors')
+def submit_actor_job(payload):
+    return submit_job(payload, 'actors')
+
+
+@api.route('/actors/jobs/<int:job_id>')
+@requires_auth('get:actors')
+def get_actor_job(payload, job_id):
+    return get_job('actors', job_id)
+
+
+@api.route('/actors/jobs/<int:job_id>', methods=["DELETE"])
+@requires_auth('get:actors')
+def cancel_actor_job(payload, job_id):
+    return cancel_job(payload, 'actors', job_id)
+
+
+@api.route('/actors/jobs/<int:job_id>/result')
+@requires_auth('get:actors')
+def get_actor_job_result(payload, job_id):
+    return get_job_result('actors', job_id)
+
+
+def changes_cursor():
+    since = request.headers.get('Last-Event-ID', None) or \
+        request.args.get('since', 0)
+    limit = request.args.get('limit', current_app.config['CHANGES_PAGE_SIZE'],
+                             type=int)
+
+    try:
+        since = int(since)
+    except ValueError:
+        abort(400)
+
+    if since < 0 or limit < 1:
+        abort(400)
+
+    return since, min(limit, current_app.config['CHANGES_PAGE_SIZE'])
+
+
+@api.route('/changes')
+@requires_auth('get:movies')
+def get_changes(payload):
+    check_permissions('get:actors', payload)
+    since, limit = changes_cursor()
+
+    changes = changes_since(since, limit)
+
+    return jsonify({
+        "success": True,
+        "changes": changes,
+        "cursor": changes[-1]['cursor'] if changes else since
+    })
+
+
+@api.route('/changes/stream')
+@requires_auth('get:movies')
+def stream_changes_events(payload):
+    check_permissions('get:actors', payload)
+    since, limit = changes_cursor()
+
+    events = stream_changes(since, limit,
+                            current_app.config['CHANGES_POLL_INTERVAL'],
+                            current_app.config['CHANGES_STREAM_SECONDS'])
+
+    return Response(stream_with_context(events),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache',
+                             'X-Accel-Buffering': 'no'})
+
 
 @api.errorhandler(404)
 def resource_not_found(error):
@@ -241,6 +603,15 @@ def method_not_found(error):
     }), 405
 
 
+@api.errorhandler(412)
+def precondition_failed(error):
+    return jsonify({
+        'success': False,
+        "error": 412,
+        "message": "Precondition failed"
+    }), 412
+
+
 @api.errorhandler(500)
 def internal_server_error(error):
     return jsonify({
@@ -250,6 +621,16 @@ def internal_server_error(error):
     }), 500
 
 
+@api.errorhandler(ValidationError)
+def validation_error(error):
+    return jsonify({
+        "success": False,
+        "error": error.status_code,
+        "message": "Unprocessable Entity",
+        "errors": error.errors
+    }), error.status_code
+
+
 @api.errorhandler(AuthError)
 def auth_error(error):
     return jsonify({
@@ -257,3 +638,12 @@ def auth_error(error):
         "error": error.status_code,
         "message": error.error['description']
     }), error.status_code
+
+
+@api.errorhandler(AdmissionError)
+def admission_error(error):
+    return jsonify({
+        "success": False,
+        "error": error.status_code,
+        "message": error.error['description']
+    }), error.status_code, {'Retry-After': str(error.retry_after)}
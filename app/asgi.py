@@ -0,0 +1,289 @@
+import asyncio
+import time
+from urllib.parse import parse_qsl
+
+from asgiref.wsgi import WsgiToAsgi
+from databases import Database
+from flask import json
+from sqlalchemy import func, select
+
+from . import create_app
+from .admission import AdmissionError
+from . import auth
+from .auth import (AuthError, check_permissions, decode_jwt,
+                   token_from_header)
+from .counts import COUNT_MODES, ESTIMATE
+from .models import Movie, Actor, association_table
+
+API_PREFIX = '/api/v1'
+
+# same envelopes as the errorhandlers in app/api.py
+MESSAGES = {
+    400: "Bad request",
+    404: "Resource was not found",
+    405: "Method not found",
+    412: "Precondition failed",
+    422: "Unprocessable Entity",
+    500: "Internal Server error"
+}
+
+
+class Abort(Exception):
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
+def async_database_url(config):
+    url = config['ASYNC_DATABASE_URL'] or config['SQLALCHEMY_DATABASE_URI']
+    return url.replace('postgres://', 'postgresql://', 1)
+
+
+def async_database(config):
+    url = async_database_url(config)
+
+    # only the asyncpg backend pools connections
+    if not url.startswith('postgresql'):
+        return Database(url)
+
+    return Database(url, min_size=config['ASYNC_DATABASE_POOL_MIN'],
+                    max_size=config['ASYNC_DATABASE_POOL_MAX'])
+
+
+class AsyncApp:
+    """ASGI application for the async serving mode.
+
+    The collection endpoints are served natively with an async database
+    pool and cached signing keys, so a single worker keeps many of them in
+    flight. Every other route is handed to the Flask app on a thread.
+    """
+
+    def __init__(self, flask_app):
+        config = flask_app.config
+        self.flask_app = flask_app
+        self.fallback = WsgiToAsgi(flask_app)
+        self.database = async_database(config)
+        self.jwks_ttl = config['JWKS_CACHE_SECONDS']
+        self.connecting = None
+        self.routes = {
+            f'{API_PREFIX}/movies': ('get:movies', self.get_movies),
+            f'{API_PREFIX}/actors': ('get:actors', self.get_actors)
+        }
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+
+        route = self.routes.get(scope['path'])
+
+        if scope['type'] != 'http' or scope['method'] != 'GET' or \
+                route is None:
+            await self.fallback(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        headers = {key.decode('latin-1').lower(): value.decode('latin-1')
+                   for key, value in scope['headers']}
+        args = dict(parse_qsl(scope['query_string'].decode('latin-1')))
+        fields = {'method': 'GET', 'route': scope['path'], 'subject': None}
+        status, body, extra = await self.handle(route, headers, args, fields)
+        body = json.dumps(body).encode('utf-8')
+
+        response_headers = [(b'content-type', b'application/json')]
+        if 'origin' in headers:
+            response_headers.append((b'access-control-allow-origin', b'*'))
+        response_headers += [(key.encode(), value.encode())
+                             for key, value in extra.items()]
+
+        compression = self.flask_app.extensions.get('compression')
+        if compression is not None:
+            response_headers.append((b'vary', b'Accept-Encoding'))
+            encoding = compression.negotiate(headers.get('accept-encoding'))
+
+            if encoding is not None:
+                # zlib and brotli release the GIL, keep the loop free
+                compressed = await asyncio.get_running_loop() \
+                    .run_in_executor(None, compression.compress, body,
+                                     encoding)
+
+                if compressed is not None:
+                    body = compressed
+                    response_headers.append(
+                        (b'content-encoding', encoding.encode()))
+
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': response_headers})
+        await send({'type': 'http.response.body', 'body': body})
+
+        access_log = self.flask_app.extensions.get('access_log')
+        if access_log is not None:
+            # same endpoint names as the Flask views, for the sampling rates
+            access_log.log(fields, f'api.{route[1].__name__}', status,
+                           (time.perf_counter() - started) * 1000)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+
+            if message['type'] == 'lifespan.startup':
+                await self.connect()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.database.disconnect()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def connect(self):
+        # servers without lifespan support connect on the first request
+        if self.database.is_connected:
+            return
+
+        if self.connecting is None:
+            self.connecting = asyncio.ensure_future(self.database.connect())
+
+        await asyncio.shield(self.connecting)
+
+    async def handle(self, route, headers, args, fields):
+        permission, handler = route
+
+        try:
+            payload = await self.authenticate(headers, permission)
+            fields['subject'] = payload.get('sub')
+            await self.connect()
+            return 200, await handler(args), {}
+        except Abort as e:
+            return e.status_code, {
+                "success": False,
+                "error": e.status_code,
+                "message": MESSAGES[e.status_code]
+            }, {}
+        except AuthError as e:
+            return e.status_code, {
+                "success": False,
+                "error": e.status_code,
+                "message": e.error['description']
+            }, {}
+        except AdmissionError as e:
+            return e.status_code, {
+                "success": False,
+                "error": e.status_code,
+                "message": e.error['description']
+            }, {'retry-after': str(e.retry_after)}
+        except Exception as e:
+            # database, signing key and decoding failures, like Flask would
+            self.flask_app.logger.error(e)
+            return 500, {
+                "success": False,
+                "error": 500,
+                "message": MESSAGES[500]
+            }, {}
+
+    async def authenticate(self, headers, permission):
+        token = token_from_header(headers.get('authorization', None))
+        payload = decode_jwt(token, await self.signing_keys())
+        check_permissions(permission, payload)
+
+        admission = self.flask_app.extensions.get('admission')
+        if admission is not None and payload.get('sub') is not None:
+            admission.limit(payload['sub'])
+
+        return payload
+
+    async def signing_keys(self):
+        """The signing keys of app/auth.py, shared with the Flask routes"""
+        jwks = auth.signing_keys.cached()
+
+        if jwks is not None:
+            return jwks
+
+        # urlopen blocks, fetch on a thread and keep the loop free
+        return await asyncio.get_running_loop().run_in_executor(
+            None, auth.signing_keys.get, self.jwks_ttl)
+
+    async def get_movies(self, args):
+        movies, total = await self.paginate(Movie, args)
+
+        if movies:
+            cast = {movie['id']: [] for movie in movies}
+            rows = await self.database.fetch_all(
+                select([association_table.c.movie_id,
+                        association_table.c.actor_id])
+                .where(association_table.c.movie_id.in_(list(cast))))
+
+            for row in rows:
+                cast[row['movie_id']].append(row['actor_id'])
+
+            for movie in movies:
+                movie['actors'] = cast[movie['id']]
+
+        return self.collection("movies", movies, total)
+
+    async def get_actors(self, args):
+        actors, total = await self.paginate(Actor, args)
+        return self.collection("actors", actors, total)
+
+    async def paginate(self, model, args):
+        """Async twin of `paginate` in app/api.py"""
+        config = self.flask_app.config
+        count = args.get('count', config['COUNT_DEFAULT'])
+
+        try:
+            page = int(args['page']) if 'page' in args else None
+            per_page = int(args.get('per_page', config['PAGE_SIZE']))
+        except ValueError:
+            page, per_page = None, config['PAGE_SIZE']
+
+        if count not in COUNT_MODES:
+            raise Abort(400)
+
+        table = model.__table__
+        query = select([table]).order_by(table.c.id)
+
+        if page is not None:
+            if page < 1 or per_page < 1:
+                raise Abort(400)
+
+            per_page = min(per_page, config['MAX_PAGE_SIZE'])
+            query = query.offset((page - 1) * per_page).limit(per_page)
+
+        rows = await self.database.fetch_all(query)
+        items = [{column.name: row[column.name] for column in table.columns}
+                 for row in rows]
+
+        if not items:
+            raise Abort(404)
+
+        if page is None:
+            return items, None if count == 'none' else len(items)
+
+        return items, await self.count_rows(model, count)
+
+    async def count_rows(self, model, mode):
+        if mode == 'none':
+            return None
+
+        if mode == 'estimated' and \
+                self.database.url.dialect == 'postgresql':
+            estimate = await self.database.fetch_val(
+                ESTIMATE.bindparams(name=f'"{model.__tablename__}"'))
+
+            if estimate is not None and estimate >= 0:
+                return int(estimate)
+
+        return await self.database.fetch_val(
+            select([func.count(model.__table__.c.id)]))
+
+    def collection(self, name, items, total):
+        response = {
+            "success": True,
+            name: items
+        }
+
+        if total is not None:
+            response["total"] = total
+
+        return response
+
+
+def create_asgi_app(config_name):
+    return AsyncApp(create_app(config_name))
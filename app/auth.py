@@ -1,10 +1,13 @@
 import json
 import os
-from flask import request, _request_ctx_stack
+import threading
+import time
+from flask import current_app, request, _request_ctx_stack
 from functools import wraps
-from jose import jwt
 from urllib.request import urlopen
 
+from .admission import limit_subject
+
 AUTH0_DOMAIN = os.getenv('AUTH0_DOMAIN', '')
 ALGORITHMS = ['RS256']
 API_AUDIENCE = os.getenv('API_AUDIENCE', '')
@@ -24,8 +27,10 @@ class AuthError(Exception):
 
 def get_token_auth_header():
     """Obtains the access token from the Authorization Header"""
-    auth_header = request.headers.get('Authorization', None)
+    return token_from_header(request.headers.get('Authorization', None))
+
 
+def token_from_header(auth_header):
     if not auth_header:
         raise AuthError({
             'code': 'auth_header_missing',
@@ -73,9 +78,66 @@ def check_permissions(permission, payload):
     return True
 
 
+def jwks_url():
+    return f'https://{AUTH0_DOMAIN}/.well-known/jwks.json'
+
+
+class SigningKeys:
+    """The Auth0 signing keys, fetched again after JWKS_CACHE_SECONDS"""
+
+    def __init__(self):
+        self.jwks = None
+        self.expires = 0
+        self.lock = threading.Lock()
+
+    def cached(self):
+        """Returns the keys unless they need fetching"""
+        if self.jwks is not None and time.monotonic() < self.expires:
+            return self.jwks
+
+        return None
+
+    def get(self, ttl):
+        jwks = self.cached()
+
+        if jwks is not None:
+            return jwks
+
+        # one request thread fetches, the others wait for its keys
+        with self.lock:
+            if self.jwks is None or time.monotonic() >= self.expires:
+                self.jwks = fetch_jwks()
+                self.expires = time.monotonic() + ttl
+
+        return self.jwks
+
+
+signing_keys = SigningKeys()
+
+
+def fetch_jwks():
+    with urlopen(jwks_url(), timeout=10) as response:
+        return json.loads(response.read())
+
+
+def get_jwks():
+    return signing_keys.get(current_app.config['JWKS_CACHE_SECONDS'])
+
+
 def verify_decode_jwt(token):
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
+    return decode_jwt(token, get_jwks())
+
+
+def warm_up():
+    """Imports python-jose ahead of the first token"""
+    from jose import jwt  # noqa: F401
+
+
+def decode_jwt(token, jwks):
+    # python-jose pulls in ecdsa, which dominates the startup time, see
+    # warm_up
+    from jose import jwt
+
     unverified_header = jwt.get_unverified_header(token)
     rsa_key = {}
     if 'kid' not in unverified_header:
@@ -137,6 +199,8 @@ def requires_auth(permission=''):
             token = get_token_auth_header()
             payload = verify_decode_jwt(token)
             check_permissions(permission, payload)
+            request.environ['casting.subject'] = payload.get('sub')
+            limit_subject(payload)
             return f(payload, *args, **kwargs)
 
         return wrapper
@@ -0,0 +1,70 @@
+import time
+
+from flask import json
+
+from app import db, queries
+from .models import Movie, Actor, Change
+
+RESOURCES = {
+    'movie': Movie,
+    'actor': Actor
+}
+
+
+def changes_since(since, limit):
+    """Returns the change events after the `since` cursor in commit order.
+
+    Create and update events carry the current state of the resource,
+    loaded with one query per resource type.
+    """
+    changes = Change.query.filter(Change.id > since) \
+        .order_by(Change.id).limit(limit).all()
+
+    wanted = {}
+    for change in changes:
+        if change.action != 'delete':
+            wanted.setdefault(change.resource, set()).add(change.resource_id)
+
+    current = {}
+    for resource, ids in wanted.items():
+        model = RESOURCES[resource]
+        for item in queries.by_ids(model, ids):
+            current[(resource, item.id)] = item.format()
+
+    events = []
+    for change in changes:
+        event = change.format()
+        data = current.get((change.resource, change.resource_id))
+
+        if data is not None:
+            event['data'] = data
+
+        events.append(event)
+
+    return events
+
+
+def stream_changes(since, limit, interval, duration):
+    """Yields change events as Server-Sent Events, polling for new ones.
+
+    The stream ends after `duration` seconds so that it doesn't hold a
+    worker thread forever, EventSource clients reconnect on their own.
+    """
+    deadline = time.monotonic() + duration
+
+    while True:
+        events = changes_since(since, limit)
+
+        # end the read transaction so the next poll sees new commits
+        db.session.commit()
+
+        for event in events:
+            since = event['cursor']
+            yield f'id: {since}\nevent: change\ndata: {json.dumps(event)}\n\n'
+
+        if time.monotonic() >= deadline:
+            return
+
+        if len(events) < limit:
+            yield ': keep-alive\n\n'
+            time.sleep(interval)
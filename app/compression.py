@@ -0,0 +1,170 @@
+import hashlib
+import threading
+import zlib
+from collections import OrderedDict
+
+from flask import current_app, request
+from werkzeug.http import parse_accept_header
+
+try:
+    import brotli
+except ImportError:  # br is only offered when the package is installed
+    brotli = None
+
+
+class GzipCompressor:
+    def __init__(self, level):
+        # wbits 31 writes the gzip container, with a fixed mtime of 0
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def process(self, chunk):
+        return self.compressor.compress(chunk)
+
+    def flush(self):
+        return self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self.compressor.flush()
+
+
+class BrotliCompressor:
+    def __init__(self, quality):
+        self.compressor = brotli.Compressor(quality=quality)
+
+    def process(self, chunk):
+        return self.compressor.process(chunk)
+
+    def flush(self):
+        return self.compressor.flush()
+
+    def finish(self):
+        return self.compressor.finish()
+
+
+class Compression:
+    """Compresses responses for the encodings a client accepts.
+
+    Bodies smaller than COMPRESS_MIN_SIZE are sent as they are. Compressed
+    bodies are kept in an LRU cache keyed by their digest, so serving the
+    same payload again costs a hash instead of a compression. Streamed
+    responses are compressed chunk by chunk and flushed after each one.
+    """
+
+    def __init__(self, config):
+        self.min_size = config['COMPRESS_MIN_SIZE']
+        self.mimetypes = config['COMPRESS_MIMETYPES']
+        self.cache_bytes = config['COMPRESS_CACHE_BYTES']
+        self.compressors = {
+            'gzip': lambda: GzipCompressor(config['COMPRESS_LEVEL'])
+        }
+
+        # preferred over gzip when the client accepts both equally
+        if brotli is not None:
+            self.compressors = {
+                'br': lambda: BrotliCompressor(
+                    config['COMPRESS_BROTLI_QUALITY']),
+                **self.compressors
+            }
+
+        self.cache = OrderedDict()
+        self.cached_bytes = 0
+        self.lock = threading.Lock()
+
+    def negotiate(self, accept_encoding):
+        """Returns the encoding to use for an Accept-Encoding header"""
+        if not accept_encoding:
+            return None
+
+        return parse_accept_header(accept_encoding).best_match(
+            list(self.compressors))
+
+    def compress(self, body, encoding):
+        """Returns `body` compressed, or None when that does not pay off"""
+        if len(body) < self.min_size:
+            return None
+
+        key = (hashlib.sha1(body).digest(), encoding)
+
+        with self.lock:
+            compressed = self.cache.get(key)
+
+            if compressed is not None:
+                self.cache.move_to_end(key)
+                return compressed or None
+
+        compressor = self.compressors[encoding]()
+        compressed = compressor.process(body) + compressor.finish()
+
+        # remembered as empty so incompressible bodies aren't retried
+        if len(compressed) >= len(body):
+            compressed = b''
+
+        with self.lock:
+            if key not in self.cache:
+                self.cache[key] = compressed
+                self.cached_bytes += len(compressed)
+
+            while self.cache and self.cached_bytes > self.cache_bytes:
+                _, evicted = self.cache.popitem(last=False)
+                self.cached_bytes -= len(evicted)
+
+        return compressed or None
+
+    def stream(self, chunks, encoding, charset='utf-8'):
+        compressor = self.compressors[encoding]()
+
+        try:
+            for chunk in chunks:
+                if isinstance(chunk, str):
+                    chunk = chunk.encode(charset)
+
+                # flushed so that events and export rows are not held back
+                data = compressor.process(chunk) + compressor.flush()
+
+                if data:
+                    yield data
+
+            yield compressor.finish()
+        finally:
+            if hasattr(chunks, 'close'):
+                chunks.close()
+
+    def apply(self, response):
+        if response.mimetype not in self.mimetypes or \
+                response.status_code < 200 or \
+                response.status_code in (204, 206, 304) or \
+                'Content-Encoding' in response.headers:
+            return response
+
+        response.vary.add('Accept-Encoding')
+        encoding = self.negotiate(request.headers.get('Accept-Encoding'))
+
+        if encoding is None or request.method == 'HEAD':
+            return response
+
+        if response.is_streamed:
+            response.response = self.stream(response.response, encoding,
+                                            response.charset)
+            response.headers.pop('Content-Length', None)
+        else:
+            compressed = self.compress(response.get_data(), encoding)
+
+            if compressed is None:
+                return response
+
+            response.set_data(compressed)
+
+        response.headers['Content-Encoding'] = encoding
+        return response
+
+
+def compress_response(response):
+    return current_app.extensions['compression'].apply(response)
+
+
+def init_app(app):
+    if not app.config['COMPRESS_ENABLED']:
+        return
+
+    app.extensions['compression'] = Compression(app.config)
+    app.after_request(compress_response)
@@ -1,9 +1,113 @@
 import os
+import tempfile
+
+from sqlalchemy.pool import QueuePool
 
 
 class Config:
     SQLALCHEMY_TRACK_MODIFICATIONS = False
 
+    # Read replicas for GET requests, writers stick to the primary for a
+    # while so they read their own writes
+    SQLALCHEMY_REPLICA_URIS = [
+        uri for uri in os.getenv('DATABASE_REPLICA_URLS', '').split(',') if uri
+    ]
+    REPLICA_STICKY_HEADER = 'Casting-Primary-Until'
+    REPLICA_STICKY_COOKIE = 'casting_primary_until'
+    REPLICA_STICKY_SECONDS = int(os.getenv('REPLICA_STICKY_SECONDS', 5))
+    REPLICA_MAX_SUBJECTS = 10000
+    REPLICA_HEALTH_INTERVAL = 5
+    REPLICA_RETRY_INTERVAL = 30
+    REPLICA_CONNECT_TIMEOUT = 2
+    # "get" routes the reads of GET requests, "all" any read outside a
+    # transaction that wrote, for replicas that share the primary's storage
+    REPLICA_READS = 'get'
+    REPLICA_ENGINE_OPTIONS = None
+
+    # Admission control, limits are per worker process
+    ADMISSION_ENABLED = True
+    ADMISSION_READ_CONCURRENCY = int(
+        os.getenv('ADMISSION_READ_CONCURRENCY', 32))
+    ADMISSION_WRITE_CONCURRENCY = int(
+        os.getenv('ADMISSION_WRITE_CONCURRENCY', 8))
+    ADMISSION_STREAM_CONCURRENCY = int(
+        os.getenv('ADMISSION_STREAM_CONCURRENCY', 8))
+    ADMISSION_QUEUE_TIMEOUT = float(os.getenv('ADMISSION_QUEUE_TIMEOUT', 0.05))
+    ADMISSION_RETRY_AFTER = int(os.getenv('ADMISSION_RETRY_AFTER', 1))
+    ADMISSION_SUBJECT_RATE = float(os.getenv('ADMISSION_SUBJECT_RATE', 10))
+    ADMISSION_SUBJECT_BURST = int(os.getenv('ADMISSION_SUBJECT_BURST', 20))
+    ADMISSION_MAX_SUBJECTS = 10000
+
+    # Collection endpoints, COUNT_DEFAULT is one of exact, estimated, none
+    PAGE_SIZE = 50
+    MAX_PAGE_SIZE = 1000
+    COUNT_DEFAULT = os.getenv('COUNT_DEFAULT', 'exact')
+
+    # Batch deletes, larger ones go through a delete job
+    MAX_DELETE_IDS = 10000
+
+    # Run the hot queries as server-side prepared statements on PostgreSQL,
+    # not for poolers that share server connections per transaction
+    PREPARED_STATEMENTS = os.getenv('PREPARED_STATEMENTS', '0') == '1'
+
+    # Structured JSON access log, ACCESS_LOG_SAMPLING holds per endpoint
+    # rates like "api.get_movies=0.1,api.get_actors=0.1"
+    ACCESS_LOG_ENABLED = os.getenv('ACCESS_LOG_ENABLED', '1') == '1'
+    ACCESS_LOG_FILE = os.getenv('ACCESS_LOG_FILE')
+    ACCESS_LOG_QUEUE_SIZE = 10000
+    ACCESS_LOG_SAMPLE_RATE = float(os.getenv('ACCESS_LOG_SAMPLE_RATE', 1))
+    ACCESS_LOG_SAMPLING = {
+        endpoint: float(rate) for endpoint, rate in (
+            item.split('=') for item in
+            os.getenv('ACCESS_LOG_SAMPLING', '').split(',') if item)
+    }
+    ACCESS_LOG_SLOW_MS = float(os.getenv('ACCESS_LOG_SLOW_MS', 500))
+
+    # Response compression, br is offered when the brotli package is installed
+    COMPRESS_ENABLED = os.getenv('COMPRESS_ENABLED', '1') == '1'
+    COMPRESS_MIN_SIZE = 1024
+    COMPRESS_LEVEL = int(os.getenv('COMPRESS_LEVEL', 6))
+    COMPRESS_BROTLI_QUALITY = int(os.getenv('COMPRESS_BROTLI_QUALITY', 4))
+    COMPRESS_MIMETYPES = frozenset([
+        'application/json', 'application/x-ndjson', 'text/csv',
+        'text/event-stream', 'text/plain'
+    ])
+    COMPRESS_CACHE_BYTES = 16 * 1024 * 1024
+
+    # Async serving mode (asgi:app)
+    ASYNC_DATABASE_URL = os.getenv('ASYNC_DATABASE_URL')
+    ASYNC_DATABASE_POOL_MIN = int(os.getenv('ASYNC_DATABASE_POOL_MIN', 1))
+    ASYNC_DATABASE_POOL_MAX = int(os.getenv('ASYNC_DATABASE_POOL_MAX', 20))
+
+    # Auth0 signing keys are fetched again after this many seconds
+    JWKS_CACHE_SECONDS = 600
+
+    CHANGES_PAGE_SIZE = 500
+    CHANGES_POLL_INTERVAL = float(os.getenv('CHANGES_POLL_INTERVAL', 1))
+    # streams end after this long, clients reconnect with Last-Event-ID
+    CHANGES_STREAM_SECONDS = int(os.getenv('CHANGES_STREAM_SECONDS', 300))
+
+    # In-memory co-star graph, falls back to SQL when disabled
+    COSTAR_INDEX_ENABLED = os.getenv('COSTAR_INDEX_ENABLED', '1') == '1'
+    COSTAR_INDEX_MAX_OVERLAY = 10000
+    # builds the graph inside the request instead of a background thread
+    COSTAR_INDEX_EAGER = False
+
+    # Catalog statistics, materialized views are refreshed on PostgreSQL
+    STATS_REFRESH_INTERVAL = int(os.getenv('STATS_REFRESH_INTERVAL', 300))
+    STATS_CACHE_TTL = int(os.getenv('STATS_CACHE_TTL', 60))
+
+    # Background jobs, JOBS_EAGER runs them inside the submitting request
+    JOBS_EAGER = False
+    JOBS_MAX_WORKERS = int(os.getenv('JOBS_MAX_WORKERS', 2))
+    JOBS_BATCH_SIZE = 500
+    JOBS_STALE_AFTER = int(os.getenv('JOBS_STALE_AFTER', 600))
+    JOBS_RECOVER_INTERVAL = int(os.getenv('JOBS_RECOVER_INTERVAL', 60))
+    JOBS_EXPORT_DIR = os.getenv('JOBS_EXPORT_DIR', os.path.join(
+        tempfile.gettempdir(), 'casting-exports'))
+    # export files are removed after this many seconds
+    JOBS_EXPORT_RETENTION = int(os.getenv('JOBS_EXPORT_RETENTION', 86400))
+
 
 class DevelopmentConfig(Config):
     DEBUG = True
@@ -13,6 +117,11 @@ class DevelopmentConfig(Config):
 class TestingConfig(Config):
     DEBUG = True
     SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    SQLALCHEMY_REPLICA_URIS = []
+    JOBS_EAGER = True
+    JOBS_RECOVER_INTERVAL = 0
+    COSTAR_INDEX_EAGER = True
+    ACCESS_LOG_ENABLED = False
 
 
 class ProductionConfig(Config):
@@ -20,9 +129,45 @@ class ProductionConfig(Config):
     SQLALCHEMY_DATABASE_URI = os.getenv('DATABASE_URL')
 
 
+class SQLiteConfig(ProductionConfig):
+    """Single node production on a SQLite file, see app/sqlite.py.
+
+    Each worker writes through one connection and reads through a pool of
+    query-only connections on the same file, WAL lets them run alongside
+    the writer.
+    """
+    SQLITE_PATH = os.path.abspath(os.getenv('SQLITE_PATH', 'casting.db'))
+    SQLITE_READERS = int(os.getenv('SQLITE_READERS', 8))
+    SQLITE_PRAGMAS = {
+        'journal_mode': 'WAL',
+        # WAL stays consistent without a sync per commit, only the last
+        # transactions can be lost on power failure
+        'synchronous': 'NORMAL',
+        'cache_size': -int(os.getenv('SQLITE_CACHE_KB', 64 * 1024)),
+        'mmap_size': int(os.getenv('SQLITE_MMAP_BYTES', 256 * 1024 * 1024)),
+        'busy_timeout': int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', 5000)),
+        'temp_store': 'MEMORY',
+        'foreign_keys': 'ON'
+    }
+
+    SQLALCHEMY_DATABASE_URI = f'sqlite:///{SQLITE_PATH}'
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        'poolclass': QueuePool,
+        'pool_size': 1,
+        'max_overflow': 0,
+        'pool_timeout': SQLITE_PRAGMAS['busy_timeout'] / 1000,
+        'connect_args': {'check_same_thread': False}
+    }
+    SQLALCHEMY_REPLICA_URIS = [SQLALCHEMY_DATABASE_URI]
+    REPLICA_READS = 'all'
+    REPLICA_ENGINE_OPTIONS = dict(SQLALCHEMY_ENGINE_OPTIONS,
+                                  pool_size=SQLITE_READERS)
+
+
 config = {
     'development': DevelopmentConfig,
     'testing': TestingConfig,
     'production': ProductionConfig,
+    'sqlite': SQLiteConfig,
     'default': DevelopmentConfig
 }
@@ -0,0 +1,47 @@
+from sqlalchemy import text
+
+from app import db, queries
+
+COUNT_MODES = ('exact', 'estimated', 'none')
+
+# the same extrapolation the planner does, last ANALYZE density times the
+# current number of pages
+ESTIMATE = text('''
+    SELECT CASE WHEN relpages > 0
+                THEN reltuples / relpages * (pg_relation_size(oid) /
+                     current_setting('block_size')::int)
+                ELSE -1 END
+    FROM pg_class WHERE oid = CAST(:name AS regclass)
+''')
+
+
+def estimate_rows(model):
+    """Returns the planner's row estimate, or None without statistics"""
+    if db.engine.dialect.name != 'postgresql':
+        return None
+
+    estimate = db.session.execute(
+        ESTIMATE, {'name': f'"{model.__tablename__}"'}).scalar()
+
+    if estimate is None or estimate < 0:
+        return None
+
+    return int(estimate)
+
+
+def count_rows(model, mode):
+    """Counts the rows of `model` as precisely as `mode` asks for.
+
+    `estimated` falls back to an exact count when there are no planner
+    statistics, e.g. on SQLite or before the first ANALYZE.
+    """
+    if mode == 'none':
+        return None
+
+    if mode == 'estimated':
+        estimate = estimate_rows(model)
+
+        if estimate is not None:
+            return estimate
+
+    return queries.count(model)
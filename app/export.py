@@ -0,0 +1,177 @@
+import csv
+import io
+import threading
+from datetime import date
+from queue import Queue, Empty, Full
+
+from flask import json
+from sqlalchemy import select
+
+from app import db
+from .models import Movie, Actor, association_table
+from .routing import read_engine
+
+FORMATS = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson'
+}
+
+
+def movie_rows():
+    """One row per movie and cast member, movies without cast included"""
+    return select([
+        Movie.id,
+        Movie.title,
+        Movie.release_date,
+        association_table.c.actor_id
+    ]).select_from(
+        Movie.__table__.outerjoin(association_table)
+    ).order_by(Movie.id, association_table.c.actor_id)
+
+
+def actor_rows():
+    """One row per actor and movie, actors without movies included"""
+    return select([
+        Actor.id,
+        Actor.name,
+        Actor.age,
+        Actor.gender,
+        association_table.c.movie_id
+    ]).select_from(
+        Actor.__table__.outerjoin(association_table)
+    ).order_by(Actor.id, association_table.c.movie_id)
+
+
+STATEMENTS = {
+    'movies': movie_rows,
+    'actors': actor_rows
+}
+
+
+def _value(value):
+    return value.isoformat() if isinstance(value, date) else value
+
+
+def _csv_chunks(columns, batches):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+
+    for rows in batches:
+        writer.writerows([[_value(v) for v in row] for row in rows])
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')
+
+
+def _ndjson_chunks(columns, batches):
+    for rows in batches:
+        yield ''.join(
+            json.dumps(dict(zip(columns, [_value(v) for v in row]))) + '\n'
+            for row in rows
+        ).encode('utf-8')
+
+
+def _batches(result, size):
+    try:
+        while True:
+            rows = result.fetchmany(size)
+
+            if not rows:
+                return
+
+            yield rows
+    finally:
+        result.close()
+
+
+class _CopyWriter:
+    """File-like target for COPY that hands chunks to the streaming side"""
+
+    def __init__(self, chunks, stopped):
+        self.chunks = chunks
+        self.stopped = stopped
+
+    def write(self, data):
+        while True:
+            if self.stopped.is_set():
+                raise IOError('export consumer went away')
+
+            try:
+                self.chunks.put(data, timeout=1)
+                return
+            except Full:
+                pass
+
+
+def _copy_chunks(statement, engine):
+    sql = str(statement.compile(dialect=engine.dialect,
+                                compile_kwargs={'literal_binds': True}))
+    chunks = Queue(maxsize=64)
+    stopped = threading.Event()
+    done = object()
+
+    def copy():
+        connection = engine.raw_connection()
+
+        try:
+            cursor = connection.cursor()
+            cursor.copy_expert(f'COPY ({sql}) TO STDOUT WITH CSV HEADER',
+                               _CopyWriter(chunks, stopped))
+            cursor.close()
+            connection.commit()
+            chunks.put(done)
+        except Exception as e:
+            if not stopped.is_set():
+                chunks.put(e)
+        finally:
+            connection.close()
+
+    thread = threading.Thread(target=copy, daemon=True)
+    thread.start()
+
+    try:
+        while True:
+            try:
+                chunk = chunks.get(timeout=1)
+            except Empty:
+                if not thread.is_alive():
+                    return
+                continue
+
+            if chunk is done:
+                return
+
+            if isinstance(chunk, Exception):
+                raise chunk
+
+            yield chunk
+    finally:
+        stopped.set()
+
+
+def export_chunks(resource, fmt, batch_size=1000):
+    """Yields the flattened rows of `resource` as encoded CSV or NDJSON.
+
+    Rows come from a server-side cursor so memory stays flat however big
+    the table is. CSV exports on PostgreSQL are produced by COPY. Both read
+    from a replica when the session would route the SELECT to one.
+    """
+    statement = STATEMENTS[resource]()
+    engine = read_engine(db.session()) or db.get_engine()
+
+    if fmt == 'csv' and engine.dialect.name == 'postgresql':
+        return _copy_chunks(statement, engine)
+
+    result = db.session.connection(clause=statement) \
+        .execution_options(stream_results=True).execute(statement)
+    columns = list(result.keys())
+    batches = _batches(result, batch_size)
+
+    if fmt == 'csv':
+        return _csv_chunks(columns, batches)
+
+    return _ndjson_chunks(columns, batches)
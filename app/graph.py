@@ -0,0 +1,388 @@
+import threading
+from array import array
+
+from flask import current_app
+from sqlalchemy import and_, func, or_, select
+
+from app import db
+from .models import Change, association_table, chunks
+
+
+class IdMap:
+    """Remaps database ids to dense integers"""
+
+    def __init__(self):
+        self.index_of = {}
+        self.ids = array('l')
+
+    def __len__(self):
+        return len(self.ids)
+
+    def index(self, id):
+        idx = self.index_of.get(id)
+
+        if idx is None:
+            idx = self.index_of[id] = len(self.ids)
+            self.ids.append(id)
+
+        return idx
+
+
+def csr(size, pairs):
+    """Builds offsets and targets arrays for (row, column) pairs"""
+    offsets = array('l', [0]) * (size + 1)
+
+    for row, _ in pairs:
+        offsets[row + 1] += 1
+
+    for row in range(size):
+        offsets[row + 1] += offsets[row]
+
+    targets = array('l', [0]) * len(pairs)
+    fill = offsets[:-1]
+
+    for row, column in pairs:
+        targets[fill[row]] = column
+        fill[row] += 1
+
+    return offsets, targets
+
+
+def csr_row(offsets, targets, row):
+    if row + 1 >= len(offsets):
+        return ()
+
+    return targets[offsets[row]:offsets[row + 1]]
+
+
+def shortest_path(expand, source, target):
+    """Bidirectional breadth-first search between two actors.
+
+    `expand` takes a frontier of actors and yields (actor, costar, movie)
+    triples. Returns the actors and the movies linking them, or None.
+    """
+    if source == target:
+        return [source], []
+
+    parents = ({source: None}, {target: None})
+    frontiers = ([source], [target])
+
+    while frontiers[0] and frontiers[1]:
+        side = 0 if len(frontiers[0]) <= len(frontiers[1]) else 1
+        seen, other = parents[side], parents[1 - side]
+        frontier = []
+        meets = []
+
+        for actor, costar, movie in expand(frontiers[side]):
+            if costar not in seen:
+                seen[costar] = (actor, movie)
+                frontier.append(costar)
+
+                if costar in other:
+                    meets.append(costar)
+
+        frontiers[side][:] = frontier
+
+        if meets:
+            # every meet is at the same depth on this side, pick the one
+            # closest to the other end
+            best = min((walk(other, meet) for meet in meets),
+                       key=lambda half: len(half[0]))
+            meet = best[0][0]
+            halves = [walk(parents[0], meet), walk(parents[1], meet)]
+            actors = halves[0][0][::-1] + halves[1][0][1:]
+            movies = halves[0][1][::-1] + halves[1][1]
+            return actors, movies
+
+    return None
+
+
+def walk(parents, node):
+    actors, movies = [node], []
+
+    while parents[node] is not None:
+        node, movie = parents[node]
+        actors.append(node)
+        movies.append(movie)
+
+    return actors, movies
+
+
+def sql_expand(frontier):
+    """Expands a frontier with one self-join on the association table"""
+    left = association_table.alias()
+    right = association_table.alias()
+
+    for part in chunks(frontier):
+        yield from db.session.execute(
+            select([left.c.actor_id, right.c.actor_id, left.c.movie_id])
+            .where(left.c.movie_id == right.c.movie_id)
+            .where(left.c.actor_id.in_(part))
+            .where(right.c.actor_id != left.c.actor_id)
+        )
+
+
+def sql_costars(actor_id):
+    return sorted({costar for _, costar, _ in sql_expand([actor_id])})
+
+
+class Snapshot:
+    """In-memory actor/movie graph built from the association table.
+
+    Both directions are stored as CSR arrays over remapped ids. Casts
+    changed after the build go to an overlay that is filled by tailing the
+    change log.
+    """
+
+    def __init__(self):
+        # read the cursor first, replaying a change twice is harmless
+        self.cursor = db.session.query(func.max(Change.id)).scalar() or 0
+        rows = db.session.execute(
+            select([association_table.c.movie_id,
+                    association_table.c.actor_id])
+            .where(association_table.c.movie_id.isnot(None))
+            .where(association_table.c.actor_id.isnot(None))
+        )
+
+        self.movies = IdMap()
+        self.actors = IdMap()
+        pairs = {(self.movies.index(movie_id), self.actors.index(actor_id))
+                 for movie_id, actor_id in rows}
+
+        self.movie_offsets, self.movie_actors = csr(len(self.movies), pairs)
+        self.actor_offsets, self.actor_movies = csr(
+            len(self.actors), [(actor, movie) for movie, actor in pairs])
+        self.casts = {}
+        self.added = {}
+        self.removed = {}
+
+    def cast(self, movie):
+        cast = self.casts.get(movie)
+
+        if cast is None:
+            return csr_row(self.movie_offsets, self.movie_actors, movie)
+
+        return cast
+
+    def movies_of(self, actor):
+        movies = csr_row(self.actor_offsets, self.actor_movies, actor)
+
+        if actor not in self.added and actor not in self.removed:
+            return movies
+
+        return (set(movies) | self.added.get(actor, set())) - \
+            self.removed.get(actor, set())
+
+    def set_cast(self, movie, cast):
+        old = set(self.cast(movie))
+
+        for actor in old - cast:
+            self.removed.setdefault(actor, set()).add(movie)
+            self.added.get(actor, set()).discard(movie)
+
+        for actor in cast - old:
+            self.added.setdefault(actor, set()).add(movie)
+            self.removed.get(actor, set()).discard(movie)
+
+        self.casts[movie] = cast
+
+    def sync(self, limit):
+        """Applies up to `limit` cast changes committed since the last sync.
+
+        Only movie changes and actor deletes change a cast, the others are
+        skipped. Returns False when more changes are left.
+        """
+        head = db.session.query(func.max(Change.id)).scalar() or 0
+        changes = db.session.query(
+            Change.id, Change.resource, Change.resource_id, Change.action
+        ).filter(Change.id > self.cursor, Change.id <= head) \
+            .filter(or_(Change.resource == 'movie',
+                        and_(Change.resource == 'actor',
+                             Change.action == 'delete'))) \
+            .order_by(Change.id).limit(limit).all()
+
+        casts = {resource_id: set() for _, resource, resource_id, _ in changes
+                 if resource == 'movie'}
+        deleted_actors = {resource_id for _, resource, resource_id, _
+                          in changes if resource == 'actor'}
+
+        for part in chunks(casts):
+            for movie_id, actor_id in db.session.execute(
+                    select([association_table.c.movie_id,
+                            association_table.c.actor_id])
+                    .where(association_table.c.movie_id.in_(part))):
+                if actor_id is not None:
+                    casts[movie_id].add(actor_id)
+
+        for movie_id, actor_ids in casts.items():
+            self.set_cast(self.movies.index(movie_id),
+                          {self.actors.index(a) for a in actor_ids})
+
+        for actor_id in deleted_actors:
+            actor = self.actors.index_of.get(actor_id)
+
+            if actor is not None:
+                for movie in list(self.movies_of(actor)):
+                    self.set_cast(movie, set(self.cast(movie)) - {actor})
+
+        if len(changes) < limit:
+            self.cursor = head
+            return True
+
+        self.cursor = changes[-1][0]
+        return False
+
+    def expand(self, frontier):
+        for actor in frontier:
+            for movie in self.movies_of(actor):
+                for costar in self.cast(movie):
+                    if costar != actor:
+                        yield actor, costar, movie
+
+    def costars(self, actor_id):
+        actor = self.actors.index_of.get(actor_id)
+
+        if actor is None:
+            return []
+
+        return sorted({self.actors.ids[costar]
+                       for _, costar, _ in self.expand([actor])})
+
+    def shortest_path(self, source_id, target_id):
+        if source_id == target_id:
+            return [source_id], []
+
+        source = self.actors.index_of.get(source_id)
+        target = self.actors.index_of.get(target_id)
+
+        if source is None or target is None:
+            return None
+
+        found = shortest_path(self.expand, source, target)
+
+        if found is None:
+            return None
+
+        actors, movies = found
+        return ([self.actors.ids[actor] for actor in actors],
+                [self.movies.ids[movie] for movie in movies])
+
+
+class CastIndex:
+    """Serves the co-star queries from a Snapshot.
+
+    Snapshots are built in a background thread, requests are answered with
+    SQL until the first one is ready. Each request applies at most
+    `max_overlay` pending cast changes to the current snapshot, once its
+    overlay grows past `max_overlay` movies a new snapshot is built in the
+    background while the current one keeps serving. With `eager` the
+    snapshots are built inside the request instead.
+    """
+
+    def __init__(self, app, max_overlay, eager=False):
+        self.app = app
+        self.max_overlay = max_overlay
+        self.eager = eager
+        self.lock = threading.RLock()
+        self.snapshot = None
+        self.builder = None
+
+    def current(self):
+        """Returns the synced snapshot, or None before the first build.
+
+        Must be called with the lock held, which also guards the snapshot
+        while it is queried.
+        """
+        if self.snapshot is None:
+            if self.eager:
+                self.snapshot = self.build()
+            else:
+                self.start_builder()
+                return None
+
+        self.snapshot.sync(self.max_overlay)
+
+        if len(self.snapshot.casts) > self.max_overlay:
+            if self.eager:
+                self.snapshot = self.build()
+            else:
+                self.start_builder()
+
+        return self.snapshot
+
+    def build(self):
+        snapshot = Snapshot()
+
+        while not snapshot.sync(self.max_overlay):
+            pass
+
+        return snapshot
+
+    def start_builder(self):
+        if self.builder is None:
+            self.builder = threading.Thread(
+                target=self.rebuild, daemon=True, name='casting-costars')
+            self.builder.start()
+
+    def rebuild(self):
+        with self.app.app_context():
+            try:
+                # built and caught up without the lock, the requests keep
+                # using the current snapshot meanwhile
+                snapshot = self.build()
+
+                with self.lock:
+                    snapshot.sync(self.max_overlay)
+                    self.snapshot = snapshot
+            except Exception as e:
+                self.app.logger.error(e)
+            finally:
+                with self.lock:
+                    self.builder = None
+
+    def costars(self, actor_id):
+        with self.lock:
+            snapshot = self.current()
+
+            if snapshot is not None:
+                return snapshot.costars(actor_id)
+
+        return sql_costars(actor_id)
+
+    def shortest_path(self, source_id, target_id):
+        with self.lock:
+            snapshot = self.current()
+
+            if snapshot is not None:
+                return snapshot.shortest_path(source_id, target_id)
+
+        return shortest_path(sql_expand, source_id, target_id)
+
+
+def costars(actor_id):
+    index = current_index()
+
+    if index is not None:
+        return index.costars(actor_id)
+
+    return sql_costars(actor_id)
+
+
+def degrees_of_separation(source_id, target_id):
+    index = current_index()
+
+    if index is not None:
+        return index.shortest_path(source_id, target_id)
+
+    return shortest_path(sql_expand, source_id, target_id)
+
+
+def current_index():
+    return current_app.extensions.get('costars')
+
+
+def init_app(app):
+    if app.config['COSTAR_INDEX_ENABLED']:
+        app.extensions['costars'] = CastIndex(
+            app, app.config['COSTAR_INDEX_MAX_OVERLAY'],
+            app.config['COSTAR_INDEX_EAGER'])
@@ -0,0 +1,320 @@
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from sqlalchemy import select
+from sqlalchemy.exc import SQLAlchemyError
+
+from app import db
+from .export import export_chunks
+from .models import Movie, Actor, Job, delete_rows, record_change
+from .schemas import ACTOR, MOVIE
+
+MODELS = {
+    'movies': Movie,
+    'actors': Actor
+}
+
+# permission verb needed to submit or cancel each operation
+OPERATIONS = {
+    'import': 'post',
+    'export': 'get',
+    'delete': 'delete'
+}
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class JobContext:
+    """Handed to the operations to report progress and notice cancellation"""
+
+    def __init__(self, job, batch_size):
+        self.job = job
+        self.batch_size = batch_size
+
+    def checkpoint(self, progress):
+        """Commits the current batch together with the job's progress"""
+        self.job.progress = progress
+        self.job.updated_at = datetime.utcnow()
+        db.session.commit()
+
+        if self.cancelled():
+            raise JobCancelled()
+
+    def cancelled(self):
+        # a connection of its own, so open cursors of the job survive
+        with db.engine.connect() as connection:
+            status = connection.execute(
+                select([Job.status]).where(Job.id == self.job.id)).scalar()
+
+        return status == 'cancelling'
+
+    def heartbeat(self):
+        """Tells `recover` the job is alive while nothing is committed"""
+        with db.engine.begin() as connection:
+            connection.execute(
+                Job.__table__.update()
+                .where(Job.id == self.job.id)
+                .values(updated_at=datetime.utcnow()))
+
+    @property
+    def params(self):
+        return json.loads(self.job.params)
+
+
+def build_movie(data):
+    return Movie(title=data['title'],
+                 release_date=data.get('release_date', None),
+                 actors=data.get('actors', []))
+
+
+def build_actor(data):
+    return Actor(**data)
+
+
+BUILDERS = {
+    'movies': (MOVIE, build_movie),
+    'actors': (ACTOR, build_actor)
+}
+
+
+def run_import(ctx):
+    """Imports the valid items and reports the field errors of the others.
+
+    Each batch is validated like the POST endpoints do, with one query for
+    the referenced actors of the whole batch.
+    """
+    items = ctx.params['items']
+    schema, build = BUILDERS[ctx.job.resource]
+    done = ctx.job.progress
+    # a recovered job carries on with what its earlier batches reported
+    result = json.loads(ctx.job.result) if ctx.job.result else \
+        {'imported': 0, 'errors': []}
+
+    while done < len(items):
+        batch = items[done:done + ctx.batch_size]
+        valid, errors = schema.validate_many(batch)
+        rows = [build(data) for data in valid.values()]
+        db.session.add_all(rows)
+        db.session.flush()
+
+        for row in rows:
+            record_change(row, 'create')
+
+        result['imported'] += len(rows)
+        result['errors'].extend({'index': done + i, 'errors': errors[i]}
+                                for i in sorted(errors))
+        done += len(batch)
+        ctx.job.result = json.dumps(result)
+        ctx.checkpoint(done)
+
+    return result
+
+
+def run_delete(ctx):
+    ids = ctx.params['ids']
+    model = MODELS[ctx.job.resource]
+    done = ctx.job.progress
+
+    while done < len(ids):
+        batch = ids[done:done + ctx.batch_size]
+        delete_rows(model, batch)
+        done += len(batch)
+        ctx.checkpoint(done)
+
+    return {'deleted': done}
+
+
+def run_export(ctx, directory):
+    fmt = ctx.params['format']
+    path = os.path.join(directory, f'job-{ctx.job.id}.{fmt}')
+    size = 0
+
+    os.makedirs(directory, exist_ok=True)
+
+    with open(path, 'wb') as out:
+        for count, chunk in enumerate(export_chunks(ctx.job.resource, fmt)):
+            out.write(chunk)
+            size += len(chunk)
+
+            if count % 16 == 15:
+                ctx.heartbeat()
+
+                if ctx.cancelled():
+                    raise JobCancelled()
+
+    # exports start over when interrupted, so progress is only reported
+    # once the file is complete
+    return {'path': path, 'format': fmt, 'size': size}
+
+
+class JobRunner:
+    """Runs jobs on a bounded thread pool inside the web process.
+
+    Job state lives in the Job table, so jobs that were pending or running
+    when a worker went away are picked up again by `recover`. Every worker
+    runs it every JOBS_RECOVER_INTERVAL seconds, a job only counts as
+    abandoned once it stopped reporting for JOBS_STALE_AFTER seconds.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.eager = app.config['JOBS_EAGER']
+        self.max_workers = app.config['JOBS_MAX_WORKERS']
+        self.batch_size = app.config['JOBS_BATCH_SIZE']
+        self.stale_after = app.config['JOBS_STALE_AFTER']
+        self.recover_interval = app.config['JOBS_RECOVER_INTERVAL']
+        self.recoverer = None
+        self.stopped = threading.Event()
+        self.export_dir = app.config['JOBS_EXPORT_DIR']
+        self.export_retention = app.config['JOBS_EXPORT_RETENTION']
+        self.executor = None
+        self.lock = threading.Lock()
+
+    def submit(self, job_id):
+        if self.eager:
+            self.execute(job_id)
+            return
+
+        # the pool is created lazily so it never exists before a fork
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(
+                    max_workers=self.max_workers,
+                    thread_name_prefix='casting-job')
+
+        self.executor.submit(self.run, job_id)
+
+    def run(self, job_id):
+        with self.app.app_context():
+            try:
+                self.execute(job_id)
+            finally:
+                db.session.remove()
+
+    def execute(self, job_id):
+        claimed = Job.query.filter_by(id=job_id, status='pending').update({
+            'status': 'running',
+            'updated_at': datetime.utcnow()
+        }, synchronize_session=False)
+        db.session.commit()
+
+        if not claimed:
+            return
+
+        job = Job.query.get(job_id)
+        ctx = JobContext(job, self.batch_size)
+
+        try:
+            if job.operation == 'import':
+                result = run_import(ctx)
+            elif job.operation == 'delete':
+                result = run_delete(ctx)
+            else:
+                self.purge_exports()
+                result = run_export(ctx, self.export_dir)
+
+            job.status = 'succeeded'
+            job.result = json.dumps(result)
+        except JobCancelled:
+            db.session.rollback()
+            job.status = 'cancelled'
+        except Exception as e:
+            db.session.rollback()
+            self.app.logger.error(e)
+            job.status = 'failed'
+            job.error = str(e)
+
+        job.updated_at = datetime.utcnow()
+        db.session.commit()
+
+    def cancel(self, job):
+        """Cancels a pending job, or asks a running one to stop"""
+        for status, cancelled in (('pending', 'cancelled'),
+                                  ('running', 'cancelling')):
+            updated = Job.query.filter_by(id=job.id, status=status).update({
+                'status': cancelled,
+                'updated_at': datetime.utcnow()
+            }, synchronize_session=False)
+
+            if updated:
+                db.session.commit()
+                return True
+
+        return False
+
+    def purge_exports(self):
+        """Removes export files older than JOBS_EXPORT_RETENTION seconds"""
+        expired = time.time() - self.export_retention
+
+        try:
+            entries = list(os.scandir(self.export_dir))
+        except FileNotFoundError:
+            return
+
+        for entry in entries:
+            try:
+                if entry.is_file() and entry.stat().st_mtime < expired:
+                    os.remove(entry.path)
+            except FileNotFoundError:
+                # purged by another worker
+                pass
+
+    def start(self):
+        """Recovers jobs now and then every JOBS_RECOVER_INTERVAL seconds"""
+        self.recover()
+
+        # started on the first request so that it never exists before a fork
+        if self.recoverer is not None or self.recover_interval <= 0:
+            return
+
+        with self.lock:
+            if self.recoverer is None:
+                self.recoverer = threading.Thread(
+                    target=self.recover_forever, daemon=True,
+                    name='casting-jobs-recover')
+                self.recoverer.start()
+
+    def recover_forever(self):
+        while not self.stopped.wait(self.recover_interval):
+            with self.app.app_context():
+                try:
+                    self.recover()
+                finally:
+                    db.session.remove()
+
+    def recover(self):
+        """Requeues jobs that a dead worker left behind"""
+        stale = datetime.utcnow() - timedelta(seconds=self.stale_after)
+
+        try:
+            Job.query.filter(Job.status == 'running',
+                             Job.updated_at < stale) \
+                .update({'status': 'pending'}, synchronize_session=False)
+            Job.query.filter(Job.status == 'cancelling',
+                             Job.updated_at < stale) \
+                .update({'status': 'cancelled'}, synchronize_session=False)
+            db.session.commit()
+
+            pending = [job_id for job_id, in db.session.query(Job.id)
+                       .filter(Job.status == 'pending').order_by(Job.id)]
+        except SQLAlchemyError as e:
+            db.session.rollback()
+            self.app.logger.error(e)
+            return
+
+        self.purge_exports()
+
+        for job_id in pending:
+            self.submit(job_id)
+
+
+def init_app(app):
+    runner = JobRunner(app)
+    app.extensions['jobs'] = runner
+    app.before_first_request(runner.start)
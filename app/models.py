@@ -1,29 +1,174 @@
-from sqlalchemy import Column, String, Integer, Date, ForeignKey, Table
+import json
+from datetime import datetime
+from sqlalchemy import (Column, String, Integer, Date, DateTime, ForeignKey,
+                        Table, Text, select, text)
 from sqlalchemy.orm import relationship
+from sqlalchemy.orm.util import identity_key
 from app import db
 
 association_table = Table('association', db.Model.metadata,
-                          Column('movie_id', Integer, ForeignKey('Movie.id')),
-                          Column('actor_id', Integer, ForeignKey('Actor.id'))
+                          Column('movie_id', Integer, ForeignKey('Movie.id'),
+                                 index=True),
+                          Column('actor_id', Integer, ForeignKey('Actor.id'),
+                                 index=True)
                           )
 
 
+# arbitrary key for the advisory lock that serializes change log writers
+CHANGE_LOCK = 424243
+
+
+def lock_changes():
+    """Holds back other change log writers until this transaction ends.
+
+    Sequence ids are handed out on insert, not on commit, so without the
+    lock a reader could see id 3 committed and move its cursor past id 2
+    before that commits. SQLite allows a single writer anyway.
+    """
+    connection = db.session.connection()
+
+    if connection.dialect.name == 'postgresql':
+        connection.execute(text('SELECT pg_advisory_xact_lock(:key)'),
+                           key=CHANGE_LOCK)
+
+
+def record_change(resource, action):
+    """Adds a change log entry to the pending transaction"""
+    lock_changes()
+    db.session.add(Change(resource=resource.__tablename__.lower(),
+                          resource_id=resource.id,
+                          action=action))
+
+
+# ids per statement, below the bound parameter limit of older SQLite builds
+CHUNK_SIZE = 500
+
+
+def chunks(items, size=None):
+    """Splits `items` into lists of at most `size`, CHUNK_SIZE by default"""
+    items = list(items)
+    size = size or CHUNK_SIZE
+
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def delete_rows(model, ids, version=None):
+    """Deletes the rows of `model` with `ids` in the pending transaction.
+
+    Each chunk of ids costs one statement per table: the ids that exist
+    are locked, then their association rows, the rows themselves and the
+    change log entries go in bulk. Movies that lose deleted actors get an
+    update of their own. `version` only deletes rows at that version.
+    Returns the deleted ids.
+    """
+    table = model.__table__
+    column = association_table.c[f'{table.name.lower()}_id']
+    resource = table.name.lower()
+    # the primary, also for the SELECT that picks the rows
+    connection = db.session.connection()
+    deleted = []
+    cast_changed = set()
+
+    # before any row lock, in the order update() takes them, or a delete
+    # and a PATCH of the same row wait on each other
+    lock_changes()
+
+    for part in chunks(ids):
+        condition = table.c.id.in_(part)
+
+        if version is not None:
+            condition &= table.c.version == version
+
+        chunk = [row.id for row in connection.execute(
+            select([table.c.id]).where(condition).with_for_update())]
+
+        if not chunk:
+            continue
+
+        changes = [{'resource': resource, 'resource_id': i,
+                    'action': 'delete'} for i in chunk]
+
+        if model is Actor:
+            recast = recast_movies(connection, chunk, cast_changed)
+            changes.extend({'resource': 'movie', 'resource_id': i,
+                            'action': 'update'} for i in recast)
+            cast_changed.update(recast)
+
+        connection.execute(association_table.delete().where(
+            column.in_(chunk)))
+        connection.execute(table.delete().where(table.c.id.in_(chunk)))
+        connection.execute(Change.__table__.insert(), changes)
+        deleted.extend(chunk)
+
+    # like the ORM would, loaded instances of deleted rows are detached and
+    # movies that lost cast members are loaded again
+    for i in deleted:
+        instance = db.session.identity_map.get(identity_key(model, i))
+
+        if instance is not None:
+            db.session.expunge(instance)
+
+    for i in cast_changed:
+        instance = db.session.identity_map.get(identity_key(Movie, i))
+
+        if instance is not None:
+            db.session.expire(instance, ['version', 'actors'])
+
+    return deleted
+
+
+def recast_movies(connection, actor_ids, done=()):
+    """Bumps the version of the movies casting `actor_ids` that aren't in
+    `done` and returns them.
+
+    Their casts shrink once the actors are gone, which is a change to the
+    movie for If-Match and the change log.
+    """
+    movies = Movie.__table__
+    movie_ids = [row.movie_id for row in connection.execute(
+        select([association_table.c.movie_id]).distinct()
+        .where(association_table.c.actor_id.in_(actor_ids))
+        .where(association_table.c.movie_id.isnot(None)))
+        if row.movie_id not in done]
+
+    if movie_ids:
+        connection.execute(movies.update()
+                           .where(movies.c.id.in_(movie_ids))
+                           .values(version=movies.c.version + 1))
+
+    return movie_ids
+
+
 class Movie(db.Model):
     __tablename__ = 'Movie'
 
     id = Column(Integer, primary_key=True)
     title = Column(String, nullable=False)
     release_date = Column(Date)
-    actors = relationship("Actor", secondary=association_table)
+    # format() lists the cast, one more query per batch of movies instead
+    # of one per movie
+    actors = relationship("Actor", secondary=association_table,
+                          lazy='selectin')
+    version = Column(Integer, nullable=False, default=1)
+
+    # bumped by update(), the ORM only would when a column changed
+    __mapper_args__ = {'version_id_col': version,
+                       'version_id_generator': False}
 
     def insert(self):
         db.session.add(self)
+        db.session.flush()
+        record_change(self, 'create')
         db.session.commit()
 
     def update(self):
+        self.version += 1
+        record_change(self, 'update')
         db.session.commit()
 
     def delete(self):
+        record_change(self, 'delete')
         db.session.delete(self)
         db.session.commit()
 
@@ -32,7 +177,8 @@ class Movie(db.Model):
             'id': self.id,
             'title': self.title,
             'release_date': self.release_date,
-            'actors': [actor.id for actor in self.actors]
+            'actors': [actor.id for actor in self.actors],
+            'version': self.version
         }
 
 
@@ -43,15 +189,25 @@ class Actor(db.Model):
     name = Column(String, nullable=False)
     age = Column(Integer)
     gender = Column(String)
+    version = Column(Integer, nullable=False, default=1)
+
+    # bumped by update(), the ORM only would when a column changed
+    __mapper_args__ = {'version_id_col': version,
+                       'version_id_generator': False}
 
     def insert(self):
         db.session.add(self)
+        db.session.flush()
+        record_change(self, 'create')
         db.session.commit()
 
     def update(self):
+        self.version += 1
+        record_change(self, 'update')
         db.session.commit()
 
     def delete(self):
+        record_change(self, 'delete')
         db.session.delete(self)
         db.session.commit()
 
@@ -60,5 +216,56 @@ class Actor(db.Model):
             'id': self.id,
             'name': self.name,
             'age': self.age,
-            'gender': self.gender
+            'gender': self.gender,
+            'version': self.version
+        }
+
+
+class Change(db.Model):
+    __tablename__ = 'Change'
+
+    id = Column(Integer, primary_key=True)
+    resource = Column(String, nullable=False)
+    resource_id = Column(Integer, nullable=False)
+    action = Column(String, nullable=False)
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+    def format(self):
+        return {
+            'cursor': self.id,
+            'resource': self.resource,
+            'id': self.resource_id,
+            'action': self.action
+        }
+
+
+class Job(db.Model):
+    __tablename__ = 'Job'
+
+    id = Column(Integer, primary_key=True)
+    resource = Column(String, nullable=False)
+    operation = Column(String, nullable=False)
+    status = Column(String, nullable=False, default='pending', index=True)
+    params = Column(Text, nullable=False)
+    progress = Column(Integer, nullable=False, default=0)
+    total = Column(Integer)
+    result = Column(Text)
+    error = Column(String)
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    updated_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+    def insert(self):
+        db.session.add(self)
+        db.session.commit()
+
+    def format(self):
+        return {
+            'id': self.id,
+            'resource': self.resource,
+            'operation': self.operation,
+            'status': self.status,
+            'progress': self.progress,
+            'total': self.total,
+            'result': json.loads(self.result) if self.result else None,
+            'error': self.error
         }
@@ -0,0 +1,243 @@
+import os
+
+from sqlalchemy import event, text
+
+from app import db, queries
+from .changes import changes_since
+from .graph import sql_expand
+from .models import Movie, Actor
+
+BASELINE = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'query_plans.json')
+
+PAGE_SIZE = 50
+
+# the seeded rows are the ones with ids above :movie and :actor, sequences
+# don't go back on rollback so their ids needn't follow on directly
+SEED = [
+    text('''
+        INSERT INTO "Actor" (name, age, gender, version)
+        SELECT 'Actor ' || i, 20 + i % 50,
+               CASE WHEN i % 2 = 0 THEN 'female' ELSE 'male' END, 1
+        FROM generate_series(1, :rows) AS i
+    '''),
+    text('''
+        INSERT INTO "Movie" (title, release_date, version)
+        SELECT 'Movie ' || i, DATE '2000-01-01' + i % 7300, 1
+        FROM generate_series(1, :rows) AS i
+    '''),
+    text('''
+        INSERT INTO association (movie_id, actor_id)
+        SELECT m.id, a.id
+        FROM (SELECT id, row_number() OVER (ORDER BY id) AS i
+              FROM "Movie" WHERE id > :movie) AS m
+        CROSS JOIN generate_series(0, 2) AS j
+        JOIN (SELECT id, row_number() OVER (ORDER BY id) - 1 AS i
+              FROM "Actor" WHERE id > :actor) AS a
+          ON a.i = (m.i + j) % :rows
+    '''),
+    text('''
+        INSERT INTO "Change" (resource, resource_id, action, created_at)
+        SELECT 'actor', id, 'create', now() FROM "Actor" WHERE id > :actor
+        UNION ALL
+        SELECT 'movie', id, 'create', now() FROM "Movie" WHERE id > :movie
+    ''')
+]
+
+TABLES = ('Actor', 'Movie', 'association', 'Change')
+
+
+def cast(sample):
+    return queries.get(Movie, sample['movie']).actors
+
+
+# the lookups and collection queries behind app/api.py, reads of whole
+# tables (unpaged listings, exact counts, exports) scan by design
+CASES = {
+    'get movie': lambda sample: queries.get(Movie, sample['movie']),
+    'get actor': lambda sample: queries.get(Actor, sample['actor']),
+    'movie cast': cast,
+    'movies by ids': lambda sample: queries.by_ids(Movie, sample['movies']),
+    'actors by ids': lambda sample: queries.by_ids(Actor, sample['actors']),
+    'movies page': lambda sample: queries.listing(
+        Movie, sample['offset'], PAGE_SIZE),
+    'actors page': lambda sample: queries.listing(
+        Actor, sample['offset'], PAGE_SIZE),
+    'changes since': lambda sample: changes_since(sample['cursor'], 500),
+    'costars': lambda sample: list(sql_expand([sample['actor']]))
+}
+
+
+# relations a case may read with a sequential scan. Every case is a keyed
+# lookup or a page, so none may, whatever the baseline recorded
+SEQ_SCANS = {}
+
+
+def seed(rows):
+    """Adds `rows` movies and actors, three actors per movie, to the pending
+    transaction. Returns the ids the cases look up.
+    """
+    base = {
+        name.lower(): db.session.execute(
+            text(f'SELECT coalesce(max(id), 0) FROM "{name}"')).scalar()
+        for name in ('Movie', 'Actor')
+    }
+
+    for statement in SEED:
+        db.session.execute(statement, dict(base, rows=rows))
+
+    ids = {
+        name.lower(): [row.id for row in db.session.execute(
+            text(f'SELECT id FROM "{name}" WHERE id > :base ORDER BY id'),
+            {'base': base[name.lower()]})]
+        for name in ('Movie', 'Actor')
+    }
+    step = max(rows // 20, 1)
+    cursor = db.session.execute(
+        text('SELECT max(id) FROM "Change"')).scalar()
+
+    return {
+        'movie': ids['movie'][rows // 2],
+        'actor': ids['actor'][rows // 2],
+        'movies': ids['movie'][::step],
+        'actors': ids['actor'][::step],
+        'offset': rows // 10,
+        'cursor': cursor - 500
+    }
+
+
+def capture(fn):
+    """Runs `fn` and returns the statements it sent to the database"""
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if not executemany:
+            statements.append((statement, parameters))
+
+    event.listen(db.engine, 'before_cursor_execute', record)
+
+    try:
+        # an empty identity map, so lookups run their SELECT
+        db.session.expunge_all()
+        fn()
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', record)
+
+    return statements
+
+
+def explain(statement, parameters):
+    cursor = db.session.connection().connection.cursor()
+
+    try:
+        cursor.execute('EXPLAIN (ANALYZE, FORMAT JSON) ' + statement,
+                       parameters)
+        return cursor.fetchone()[0][0]
+    finally:
+        cursor.close()
+
+
+def scans(node):
+    """Lists how each relation under `node` is read, e.g. Seq Scan on Movie"""
+    found = []
+
+    if 'Relation Name' in node:
+        scan = f'{node["Node Type"]} on {node["Relation Name"]}'
+
+        if 'Index Name' in node:
+            scan += f' using {node["Index Name"]}'
+
+        found.append(scan)
+
+    for child in node.get('Plans', []):
+        found.extend(scans(child))
+
+    return found
+
+
+def vacuum():
+    """Clears the dead rows of earlier runs, they would shift the estimates"""
+    with db.engine.connect() as connection:
+        connection = connection.execution_options(isolation_level='AUTOCOMMIT')
+
+        for table in TABLES:
+            connection.execute(text(f'VACUUM "{table}"'))
+
+
+def collect(rows):
+    """Returns the plans of every case against a seeded dataset.
+
+    The rows are seeded and the tables analyzed inside a transaction that
+    is rolled back, so the database is left as it was.
+    """
+    vacuum()
+
+    try:
+        sample = seed(rows)
+
+        for table in TABLES:
+            db.session.execute(text(f'ANALYZE "{table}"'))
+
+        plans = {}
+
+        for name, fn in CASES.items():
+            plans[name] = []
+
+            for statement, parameters in capture(lambda: fn(sample)):
+                result = explain(statement, parameters)
+                plans[name].append({
+                    'statement': ' '.join(statement.split()),
+                    'cost': result['Plan']['Total Cost'],
+                    'scans': scans(result['Plan']),
+                    'ms': result['Execution Time']
+                })
+
+        return plans
+    finally:
+        db.session.rollback()
+
+
+def seq_scans(plans):
+    """Returns the sequential scans of `plans` that SEQ_SCANS doesn't allow"""
+    problems = []
+
+    for name, statements in plans.items():
+        allowed = SEQ_SCANS.get(name, ())
+
+        for plan in statements:
+            for scan in plan['scans']:
+                if scan.startswith('Seq Scan on ') and \
+                        scan[len('Seq Scan on '):] not in allowed:
+                    problems.append(f'{name}: {scan}')
+
+    return problems
+
+
+def compare(baseline, plans, threshold):
+    """Returns the regressions of `plans` against `baseline`.
+
+    A case regresses when it reads a relation with a sequential scan that
+    SEQ_SCANS doesn't allow, runs another number of statements than the
+    baseline, or its estimated cost grows by more than `threshold`, e.g.
+    0.5 for half.
+    """
+    problems = seq_scans(plans)
+
+    for name, current in plans.items():
+        known = baseline.get(name)
+
+        if known is None:
+            problems.append(f'{name}: not in the baseline')
+            continue
+
+        if len(current) != len(known):
+            problems.append(f'{name}: {len(current)} statements, '
+                            f'{len(known)} in the baseline')
+            continue
+
+        for plan, before in zip(current, known):
+            if plan['cost'] > before['cost'] * (1 + threshold):
+                problems.append(f'{name}: cost {before["cost"]} -> '
+                                f'{plan["cost"]}')
+
+    return problems
@@ -0,0 +1,134 @@
+import hashlib
+import re
+from collections import OrderedDict
+from functools import lru_cache
+
+from sqlalchemy import bindparam, event, func
+from sqlalchemy.engine import Engine
+from sqlalchemy.ext import baked
+
+from app import db
+
+# SQL strings of the hot queries, built and compiled once per statement shape
+bakery = baked.bakery()
+
+# prepared statements kept per database connection when PREPARED_STATEMENTS
+# is enabled, the least recently used one is deallocated beyond that
+MAX_PREPARED = 200
+
+PARAMETER = re.compile(r'%\((\w+)\)s')
+
+
+def baked_query(model):
+    bq = bakery(lambda session: session.query(model), model)
+    bq += lambda q: q.execution_options(casting_prepare=True)
+    return bq
+
+
+@lru_cache(maxsize=None)
+def by_id_query(model):
+    return baked_query(model)
+
+
+@lru_cache(maxsize=None)
+def by_ids_query(model):
+    bq = baked_query(model)
+    bq += lambda q: q.filter(model.id.in_(bindparam('ids', expanding=True)))
+    return bq
+
+
+@lru_cache(maxsize=None)
+def listing_query(model, paged):
+    bq = baked_query(model)
+    bq += lambda q: q.order_by(model.id)
+
+    if paged:
+        bq += lambda q: q.offset(bindparam('offset')) \
+            .limit(bindparam('limit'))
+
+    return bq
+
+
+@lru_cache(maxsize=None)
+def count_query(model):
+    bq = bakery(lambda session: session.query(func.count(model.id)), model)
+    bq += lambda q: q.execution_options(casting_prepare=True)
+    return bq
+
+
+def get(model, ident):
+    """`model.query.get(ident)`, the identity map is checked first"""
+    return by_id_query(model)(db.session()).get(ident)
+
+
+def by_ids(model, ids):
+    """Returns the rows of `model` with one of `ids`, in no particular order"""
+    if not ids:
+        return []
+
+    return by_ids_query(model)(db.session()).params(ids=list(ids)).all()
+
+
+def listing(model, offset=None, limit=None):
+    """Returns the rows of `model` ordered by id, optionally one page"""
+    if limit is None:
+        return listing_query(model, False)(db.session()).all()
+
+    return listing_query(model, True)(db.session()) \
+        .params(offset=offset or 0, limit=limit).all()
+
+
+def count(model):
+    return count_query(model)(db.session()).scalar()
+
+
+@lru_cache(maxsize=1024)
+def prepared(statement):
+    """Turns a pyformat statement into PREPARE and EXECUTE statements"""
+    names = list(dict.fromkeys(PARAMETER.findall(statement)))
+    positions = {name: i for i, name in enumerate(names, 1)}
+    name = 'casting_' + hashlib.sha1(statement.encode()).hexdigest()[:16]
+
+    prepare = f'PREPARE {name} AS ' + PARAMETER.sub(
+        lambda match: f'${positions[match.group(1)]}', statement)
+    execute = f'EXECUTE {name}'
+
+    if names:
+        execute += '(' + ', '.join(f'%({n})s' for n in names) + ')'
+
+    return name, prepare, execute
+
+
+def execute_prepared(conn, cursor, statement, parameters, context,
+                     executemany):
+    # only the statements of this module, escaped percent signs would need
+    # another round of unescaping
+    if executemany or conn.dialect.name != 'postgresql' or \
+            not context.execution_options.get('casting_prepare') or \
+            '%%' in statement:
+        return statement, parameters
+
+    name, prepare, execute = prepared(statement)
+    statements = conn.connection.info.setdefault('casting_prepared',
+                                                 OrderedDict())
+
+    if name in statements:
+        statements.move_to_end(name)
+    else:
+        # prepared statements belong to the session, not the transaction
+        cursor.execute(prepare)
+        statements[name] = True
+
+        if len(statements) > MAX_PREPARED:
+            evicted, _ = statements.popitem(last=False)
+            cursor.execute(f'DEALLOCATE {evicted}')
+
+    return execute, parameters
+
+
+def init_app(app):
+    if app.config['PREPARED_STATEMENTS'] and \
+            not event.contains(Engine, 'before_cursor_execute',
+                               execute_prepared):
+        event.listen(Engine, 'before_cursor_execute', execute_prepared,
+                     retval=True)
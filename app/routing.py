@@ -0,0 +1,256 @@
+import itertools
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app, has_request_context, request
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import create_engine, event, orm
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.sql import Select
+
+from . import sqlite
+from .admission import READ_METHODS
+
+
+class Replicas:
+    """Round-robin over the replica engines that passed their last ping.
+
+    A background thread pings the replicas, so requests never wait on an
+    unreachable one. Replicas are also the place to remember the subjects
+    that wrote recently.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.engines = None
+        self.up = []
+        self.down_until = []
+        self.counter = itertools.count()
+        self.monitor = None
+        self.stopped = None
+        self.writers = OrderedDict()
+        self.lock = threading.Lock()
+
+    def setup(self):
+        # engines are created on first use, after the server has forked
+        with self.lock:
+            if self.engines is None:
+                config = self.app.config
+                options = dict(config.get('REPLICA_ENGINE_OPTIONS') or
+                               config.get('SQLALCHEMY_ENGINE_OPTIONS', {}))
+                options['pool_pre_ping'] = True
+                self.engines = [
+                    sqlite.configure(
+                        create_engine(uri, **engine_options(uri, options,
+                                                            config)),
+                        config, writer=False)
+                    for uri in config['SQLALCHEMY_REPLICA_URIS']
+                ]
+                self.up = [False] * len(self.engines)
+                self.down_until = [0] * len(self.engines)
+                # once per process, bounded by REPLICA_CONNECT_TIMEOUT
+                self.check()
+
+            if self.monitor is None and self.engines:
+                self.stopped = threading.Event()
+                self.monitor = threading.Thread(
+                    target=self.check_forever, args=(self.stopped,),
+                    daemon=True, name='casting-replicas')
+                self.monitor.start()
+
+    def pick(self):
+        if self.engines is None or (self.monitor is None and self.engines):
+            self.setup()
+
+        for _ in self.engines:
+            i = next(self.counter) % len(self.engines)
+
+            if self.up[i]:
+                return self.engines[i]
+
+        return None
+
+    def ping(self, i):
+        with self.engines[i].connect() as connection:
+            connection.scalar('SELECT 1')
+
+    def check(self):
+        """Pings the replicas that aren't waiting out a failure"""
+        retry = self.app.config['REPLICA_RETRY_INTERVAL']
+
+        for i in range(len(self.engines)):
+            if self.down_until[i] > time.monotonic():
+                continue
+
+            try:
+                self.ping(i)
+            except Exception as e:
+                self.app.logger.error(e)
+                self.up[i] = False
+                self.down_until[i] = time.monotonic() + retry
+            else:
+                self.up[i] = True
+
+    def check_forever(self, stopped):
+        interval = self.app.config['REPLICA_HEALTH_INTERVAL']
+
+        while not stopped.wait(interval):
+            self.check()
+
+    def wrote(self, subject, until):
+        with self.lock:
+            self.writers.pop(subject, None)
+            self.writers[subject] = until
+
+            if len(self.writers) > self.app.config['REPLICA_MAX_SUBJECTS']:
+                self.writers.popitem(last=False)
+
+    def wrote_until(self, subject):
+        return self.writers.get(subject, 0)
+
+    def dispose(self):
+        with self.lock:
+            if self.stopped is not None:
+                self.stopped.set()
+
+            self.monitor = None
+
+        for engine in self.engines or []:
+            engine.dispose()
+
+
+def engine_options(uri, options, config):
+    """Keeps an unreachable PostgreSQL replica from hanging a ping"""
+    if make_url(uri).get_backend_name() != 'postgresql':
+        return options
+
+    connect_args = dict(options.get('connect_args', {}))
+    connect_args.setdefault('connect_timeout',
+                            config['REPLICA_CONNECT_TIMEOUT'])
+
+    return dict(options, connect_args=connect_args)
+
+
+def sticky():
+    """Clients that wrote recently read their own writes from the primary.
+
+    The subject is remembered by the worker that served the write, clients
+    that send back the header or cookie stick across workers as well.
+    """
+    config = current_app.config
+    until = request.headers.get(config['REPLICA_STICKY_HEADER']) or \
+        request.cookies.get(config['REPLICA_STICKY_COOKIE'])
+    subject = request.environ.get('casting.subject')
+    now = time.time()
+
+    if subject is not None and \
+            current_app.extensions['replicas'].wrote_until(subject) > now:
+        return True
+
+    try:
+        return until is not None and float(until) > now
+    except ValueError:
+        return False
+
+
+def read_engine(session=None):
+    """Returns the replica engine for a read, or None for the primary"""
+    if current_app.config['REPLICA_READS'] == 'all':
+        # replicas that share the storage of the primary never lag, any read
+        # goes to one until its transaction has used the primary
+        if session is not None and session.info.get('casting.primary'):
+            return None
+
+        replicas = current_app.extensions.get('replicas')
+        return replicas.pick() if replicas is not None else None
+
+    if not has_request_context() or request.method not in READ_METHODS:
+        return None
+
+    if 'casting.replica' not in request.environ:
+        replicas = current_app.extensions.get('replicas')
+        engine = None
+
+        if replicas is not None and not sticky():
+            engine = replicas.pick()
+
+        # one replica per request keeps its reads consistent
+        request.environ['casting.replica'] = engine
+
+    return request.environ['casting.replica']
+
+
+class RoutingSession(SignallingSession):
+    """Sends the SELECTs of read-only requests to a replica"""
+
+    def get_bind(self, mapper=None, clause=None):
+        if not self._flushing and isinstance(clause, Select):
+            engine = read_engine(self)
+
+            if engine is not None:
+                return engine
+
+        return super().get_bind(mapper, clause)
+
+
+@event.listens_for(RoutingSession, 'after_begin')
+def remember_primary(session, transaction, connection):
+    replicas = current_app.extensions.get('replicas')
+
+    if replicas is None or connection.engine not in (replicas.engines or []):
+        session.info['casting.primary'] = True
+
+
+@event.listens_for(RoutingSession, 'after_transaction_end')
+def forget_primary(session, transaction):
+    if transaction.parent is None:
+        session.info.pop('casting.primary', None)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        super().apply_driver_hacks(app, sa_url, options)
+
+        # create_engine isn't given the app, the primary is its one writer
+        if sa_url.drivername == 'sqlite' and app.config.get('SQLITE_PRAGMAS'):
+            options['casting.sqlite'] = app.config
+
+    def create_engine(self, sa_url, engine_opts):
+        config = engine_opts.pop('casting.sqlite', None)
+        engine = super().create_engine(sa_url, engine_opts)
+
+        if config is not None:
+            sqlite.configure(engine, config, writer=True)
+
+        return engine
+
+
+def stick_to_primary(response):
+    config = current_app.config
+
+    if not config['SQLALCHEMY_REPLICA_URIS'] or \
+            config['REPLICA_READS'] != 'get':
+        return response
+
+    if request.method not in READ_METHODS and response.status_code < 400:
+        window = config['REPLICA_STICKY_SECONDS']
+        until = time.time() + window
+        subject = request.environ.get('casting.subject')
+
+        if subject is not None:
+            current_app.extensions['replicas'].wrote(subject, until)
+
+        response.headers[config['REPLICA_STICKY_HEADER']] = str(until)
+        response.set_cookie(config['REPLICA_STICKY_COOKIE'], str(until),
+                            max_age=window, httponly=True)
+
+    return response
+
+
+def init_app(app):
+    app.extensions['replicas'] = Replicas(app)
+    app.after_request(stick_to_primary)
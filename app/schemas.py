@@ -0,0 +1,178 @@
+from datetime import datetime
+
+from . import queries
+from .models import Actor, chunks
+
+# ValidationError Exception
+
+
+class ValidationError(Exception):
+    '''A standardized way to communicate invalid request bodies'''
+
+    def __init__(self, errors, status_code=422):
+        self.errors = errors
+        self.status_code = status_code
+
+
+class Invalid(Exception):
+    pass
+
+
+class Field:
+    def __init__(self, required=False):
+        self.required = required
+
+    def convert(self, value):
+        return value
+
+
+class String(Field):
+    def convert(self, value):
+        if not isinstance(value, str):
+            raise Invalid('Must be a string')
+
+        return value
+
+
+class Integer(Field):
+    def convert(self, value):
+        # bool is an int subclass, but true is not an age
+        if type(value) is not int:
+            raise Invalid('Must be an integer')
+
+        return value
+
+
+class Date(Field):
+    def convert(self, value):
+        try:
+            return datetime.strptime(value, '%Y-%m-%d').date()
+        except (TypeError, ValueError):
+            raise Invalid('Must be a date formatted as YYYY-MM-DD')
+
+
+class Ids(Field):
+    def convert(self, value):
+        if not isinstance(value, list) or \
+                not all(type(i) is int for i in value):
+            raise Invalid('Must be a list of ids')
+
+        # duplicates would become duplicate association rows
+        return list(dict.fromkeys(value))
+
+
+class References(Ids):
+    """A list of ids of `model`, loaded in one query after all other checks"""
+
+    def __init__(self, model, required=False):
+        super().__init__(required)
+        self.model = model
+
+    def load(self, ids):
+        """Returns the rows with `ids` by id, one query per chunk of ids"""
+        return {item.id: item for part in chunks(set(ids))
+                for item in queries.by_ids(self.model, part)}
+
+    @staticmethod
+    def resolve(ids, found):
+        missing = [i for i in ids if i not in found]
+
+        if missing:
+            raise Invalid(
+                f'Unknown ids: {", ".join(str(i) for i in missing)}')
+
+        return [found[i] for i in ids]
+
+
+class Schema:
+    """Validates request bodies against declared fields.
+
+    The fields are compiled into a flat tuple of checks once, so validating
+    a body is a single pass without any lookups on the field objects.
+    References are only resolved against the database once every other
+    field passed.
+    """
+
+    def __init__(self, **fields):
+        self.checks = tuple((name, field.required, field.convert)
+                            for name, field in fields.items())
+        self.references = tuple((name, field)
+                                for name, field in fields.items()
+                                if isinstance(field, References))
+
+    def validate(self, body):
+        """Returns the converted fields of `body` or raises ValidationError"""
+        valid, errors = self.validate_many([body])
+
+        if errors:
+            raise ValidationError(errors[0])
+
+        return valid[0]
+
+    def validate_many(self, bodies):
+        """Validates a batch of bodies with one query per reference field.
+
+        Returns the converted fields of the valid bodies and the errors of
+        the others, both by position in `bodies`.
+        """
+        valid = {}
+        errors = {}
+
+        for i, body in enumerate(bodies):
+            try:
+                valid[i] = self.convert(body)
+            except ValidationError as e:
+                errors[i] = e.errors
+
+        for name, field in self.references:
+            found = field.load(id for data in valid.values()
+                               for id in data.get(name, ()))
+
+            for i, data in list(valid.items()):
+                if name in data:
+                    try:
+                        data[name] = field.resolve(data[name], found)
+                    except Invalid as e:
+                        errors[i] = {name: str(e)}
+                        del valid[i]
+
+        return valid, errors
+
+    def convert(self, body):
+        data = {}
+        errors = {}
+
+        for name, required, convert in self.checks:
+            value = body.get(name, None)
+
+            if value is None:
+                if required:
+                    errors[name] = 'Is required'
+                continue
+
+            try:
+                data[name] = convert(value)
+            except Invalid as e:
+                errors[name] = str(e)
+
+        if errors:
+            raise ValidationError(errors)
+
+        return data
+
+
+MOVIE = Schema(
+    title=String(required=True),
+    release_date=Date(),
+    actors=References(Actor)
+)
+
+ACTOR = Schema(
+    name=String(required=True),
+    age=Integer(),
+    gender=String()
+)
+
+IDS = Schema(
+    ids=Ids(required=True)
+)
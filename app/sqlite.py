@@ -0,0 +1,46 @@
+from sqlalchemy import event
+
+
+def on_connect(pragmas):
+    def connect(dbapi_connection, connection_record):
+        # pysqlite's implicit BEGIN is deferred until the first write, the
+        # begin listener below emits the one we want instead
+        dbapi_connection.isolation_level = None
+        cursor = dbapi_connection.cursor()
+
+        for name, value in pragmas.items():
+            cursor.execute(f'PRAGMA {name} = {value}')
+
+        cursor.close()
+
+    return connect
+
+
+def on_begin(statement):
+    def begin(connection):
+        connection.execute(statement)
+
+    return begin
+
+
+def configure(engine, config, writer):
+    """Applies the SQLite production profile to `engine`.
+
+    Every connection gets the SQLITE_PRAGMAS. Writers start their
+    transactions with BEGIN IMMEDIATE, so a transaction that read first
+    waits for the write lock up front instead of failing when it upgrades.
+    Readers are limited to queries and read from a WAL snapshot.
+    """
+    pragmas = config.get('SQLITE_PRAGMAS')
+
+    if engine.dialect.name != 'sqlite' or not pragmas:
+        return engine
+
+    if not writer:
+        pragmas = dict(pragmas, query_only='ON')
+
+    event.listen(engine, 'connect', on_connect(pragmas))
+    event.listen(engine, 'begin',
+                 on_begin('BEGIN IMMEDIATE' if writer else 'BEGIN'))
+
+    return engine
@@ -0,0 +1,147 @@
+import threading
+import time
+
+from flask import current_app
+from sqlalchemy import Integer, String, cast, column, extract, func, \
+    select, table, text
+
+from app import db
+from .models import Movie, Actor, association_table
+
+# arbitrary key for the advisory lock that keeps refreshes from overlapping
+REFRESH_LOCK = 424242
+
+
+def movies_per_year():
+    year = cast(extract('year', Movie.release_date), Integer)
+    key = func.coalesce(cast(year, String), 'unknown')
+    return select([key.label('key'), func.count().label('count')]) \
+        .group_by(key)
+
+
+def cast_sizes():
+    sizes = select([func.count(association_table.c.actor_id).label('size')]) \
+        .select_from(Movie.__table__.outerjoin(association_table)) \
+        .group_by(Movie.id).alias('sizes')
+    key = cast(sizes.c.size, String)
+    return select([key.label('key'), func.count().label('count')]) \
+        .group_by(key)
+
+
+def actors_by_gender():
+    key = func.coalesce(Actor.gender, 'unknown')
+    return select([key.label('key'), func.count().label('count')]) \
+        .group_by(key)
+
+
+def actors_by_age():
+    bucket = Actor.age / 10 * 10
+    key = func.coalesce(cast(bucket, String) + '-' +
+                        cast(bucket + 9, String), 'unknown')
+    return select([key.label('key'), func.count().label('count')]) \
+        .group_by(key)
+
+
+# on PostgreSQL each aggregate is a materialized view of the same name,
+# see the migration that creates them
+AGGREGATES = {
+    'movies_per_year': movies_per_year,
+    'cast_sizes': cast_sizes,
+    'actors_by_gender': actors_by_gender,
+    'actors_by_age': actors_by_age
+}
+
+
+def view(name):
+    return table(f'stats_{name}', column('key'), column('count'))
+
+
+def materialized():
+    return db.engine.dialect.name == 'postgresql'
+
+
+def compute(statements):
+    return {
+        name: {key: count for key, count in db.session.execute(statement)}
+        for name, statement in statements.items()
+    }
+
+
+def refresh_views():
+    """Refreshes the materialized views unless another worker already is"""
+    with db.engine.begin() as connection:
+        locked = connection.execute(
+            text('SELECT pg_try_advisory_xact_lock(:key)'),
+            key=REFRESH_LOCK).scalar()
+
+        if not locked:
+            return False
+
+        for name in AGGREGATES:
+            connection.execute(
+                f'REFRESH MATERIALIZED VIEW CONCURRENTLY stats_{name}')
+
+    return True
+
+
+class Statistics:
+    """Serves the catalog aggregates at a cost independent of its size.
+
+    PostgreSQL reads materialized views refreshed in the background every
+    STATS_REFRESH_INTERVAL seconds. Other databases compute the aggregates
+    and keep them for STATS_CACHE_TTL seconds.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.refresh_interval = app.config['STATS_REFRESH_INTERVAL']
+        self.cache_ttl = app.config['STATS_CACHE_TTL']
+        self.cached = None
+        self.expires = 0
+        self.refresher = None
+        self.lock = threading.Lock()
+
+    def get(self):
+        if materialized():
+            self.start_refresher()
+            return compute({name: select([view(name)])
+                            for name in AGGREGATES})
+
+        with self.lock:
+            if self.cached is None or time.monotonic() >= self.expires:
+                self.cached = compute({name: statement()
+                                       for name, statement
+                                       in AGGREGATES.items()})
+                self.expires = time.monotonic() + self.cache_ttl
+
+            return self.cached
+
+    def start_refresher(self):
+        # started on first use so that it never exists before a fork
+        if self.refresher is not None or self.refresh_interval <= 0:
+            return
+
+        with self.lock:
+            if self.refresher is None:
+                self.refresher = threading.Thread(
+                    target=self.refresh_forever, daemon=True,
+                    name='casting-stats')
+                self.refresher.start()
+
+    def refresh_forever(self):
+        while True:
+            time.sleep(self.refresh_interval)
+
+            with self.app.app_context():
+                try:
+                    refresh_views()
+                except Exception as e:
+                    self.app.logger.error(e)
+
+
+def get_stats():
+    return current_app.extensions['stats'].get()
+
+
+def init_app(app):
+    app.extensions['stats'] = Statistics(app)
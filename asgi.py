@@ -0,0 +1,6 @@
+import os
+
+from app.asgi import create_asgi_app
+
+
+app = create_asgi_app(os.getenv('FLASK_ENV') or 'default')
@@ -0,0 +1,104 @@
+"""Measures the CPU time the cached compiled queries of app/queries.py save.
+
+Every query runs once with the statement cache and once with
+`enable_baked_queries=False`, which makes SQLAlchemy build and compile the
+same query from scratch on each call like `Model.query` does.
+
+    python benchmarks/bench_queries.py --rows 2000 --iterations 2000
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from unittest import mock
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+# read by app.config on import, the log line per request would flood stdout
+os.environ['ACCESS_LOG_ENABLED'] = '0'
+
+from app import auth, create_app, db, queries  # noqa: E402
+from app.models import Movie, Actor  # noqa: E402
+
+PAYLOAD = {'permissions': ['get:movies', 'get:actors']}
+
+
+def seed(rows):
+    actors = [Actor(name=f'Actor {i}', age=20 + i % 50, version=1)
+              for i in range(rows)]
+    db.session.add_all(actors)
+    db.session.add_all([Movie(title=f'Movie {i}', actors=actors[i:i + 3],
+                              version=1) for i in range(rows)])
+    db.session.commit()
+
+
+def cpu_per_call(fn, iterations):
+    fn()
+    started = time.process_time()
+
+    for _ in range(iterations):
+        fn()
+
+    return (time.process_time() - started) / iterations * 1e6
+
+
+def use_cache(enabled):
+    db.session.remove()
+    db.session.configure(enable_baked_queries=enabled)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=2000)
+    parser.add_argument('--iterations', type=int, default=2000)
+    args = parser.parse_args()
+
+    tmp = tempfile.TemporaryDirectory()
+    app = create_app('production')
+    app.config['SQLALCHEMY_DATABASE_URI'] = \
+        f'sqlite:///{os.path.join(tmp.name, "queries.db")}'
+    app.config['ADMISSION_ENABLED'] = False
+    client = app.test_client()
+    headers = {'Authorization': 'Bearer benchmark'}
+    ids = list(range(1, args.rows, args.rows // 20))
+
+    def fresh(fn):
+        # an empty identity map, so get() has to run its SELECT
+        def call():
+            db.session.expunge_all()
+            return fn()
+        return call
+
+    benchmarks = {
+        'get': fresh(lambda: queries.get(Movie, 1)),
+        f'by_ids ({len(ids)} ids)': fresh(
+            lambda: queries.by_ids(Actor, ids)),
+        'listing (page of 50)': fresh(
+            lambda: queries.listing(Movie, 100, 50)),
+        'count': lambda: queries.count(Movie),
+        'GET /movies?page=3': lambda: client.get(
+            '/api/v1/movies?page=3&per_page=20', headers=headers)
+    }
+
+    with app.app_context(), \
+            mock.patch.object(auth, 'verify_decode_jwt',
+                              lambda token: PAYLOAD):
+        db.create_all()
+        seed(args.rows)
+
+        print(f'{"":>24} {"rebuilt":>10} {"cached":>10}  CPU us per call')
+
+        for name, fn in benchmarks.items():
+            timings = []
+
+            for enabled in (False, True):
+                use_cache(enabled)
+                timings.append(cpu_per_call(fn, args.iterations))
+
+            print(f'{name:>24} {timings[0]:10.1f} {timings[1]:10.1f}  '
+                  f'{timings[1] / timings[0] - 1:+.0%}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+"""Compares the threaded WSGI and the async ASGI serving modes.
+
+Seeds a database, starts each server in turn with the shipped
+gunicorn.conf.py and keeps `--concurrency` requests to GET /api/v1/movies
+in flight for `--duration` seconds. Both modes run `--workers` processes,
+the WSGI one with the gthread workers and thread count of the config.
+
+    python benchmarks/bench_serving.py --concurrency 200 --workers 2
+"""
+import argparse
+import asyncio
+import os
+import runpy
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def seed(rows):
+    from app import create_app, db
+    from app.models import Movie, Actor
+
+    app = create_app('production')
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        actors = [Actor(name=f'Actor {i}', age=20 + i % 50)
+                  for i in range(rows)]
+        db.session.add_all(actors)
+        db.session.add_all([Movie(title=f'Movie {i}', actors=actors[i:i + 3])
+                            for i in range(rows)])
+        db.session.commit()
+
+
+def start(command, port):
+    server = subprocess.Popen(command, cwd=ROOT, env=os.environ,
+                              stdout=subprocess.DEVNULL,
+                              stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 30
+
+    while time.monotonic() < deadline:
+        try:
+            httpx.get(f'http://127.0.0.1:{port}/api/v1/')
+            return server
+        except httpx.TransportError:
+            time.sleep(0.1)
+
+    server.kill()
+    raise RuntimeError(f'{command[0]} did not start')
+
+
+async def load(url, concurrency, duration):
+    latencies = []
+    errors = 0
+    deadline = time.monotonic() + duration
+    limits = httpx.Limits(max_connections=concurrency)
+
+    async with httpx.AsyncClient(limits=limits, timeout=60) as client:
+        async def worker():
+            nonlocal errors
+            while time.monotonic() < deadline:
+                started = time.monotonic()
+
+                try:
+                    response = await client.get(
+                        url, headers={'Authorization': 'Bearer benchmark'})
+                except httpx.TransportError:
+                    errors += 1
+                    continue
+
+                latencies.append(time.monotonic() - started)
+                errors += response.status_code != 200
+
+        await asyncio.gather(*[worker() for _ in range(concurrency)])
+
+    latencies.sort()
+    return {
+        'requests/s': len(latencies) / duration,
+        'p50 ms': latencies[len(latencies) // 2] * 1000,
+        'p99 ms': latencies[int(len(latencies) * 0.99)] * 1000,
+        'errors': errors
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database-url', default=None,
+                        help='defaults to a temporary SQLite file')
+    parser.add_argument('--rows', type=int, default=200)
+    parser.add_argument('--workers', type=int, default=2,
+                        help='worker processes of either mode')
+    parser.add_argument('--concurrency', type=int, default=100)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--port', type=int, default=8765)
+    args = parser.parse_args()
+
+    tmp = tempfile.TemporaryDirectory()
+    url = args.database_url or \
+        f'sqlite:///{os.path.join(tmp.name, "bench.db")}'
+    os.environ.update({
+        'DATABASE_URL': url,
+        'ASYNC_DATABASE_URL': url,
+        'ACCESS_LOG_ENABLED': '0',
+        'PYTHONPATH': os.pathsep.join([ROOT, os.path.join(ROOT, 'benchmarks')])
+    })
+    seed(args.rows)
+
+    bind = f'127.0.0.1:{args.port}'
+    config = ['-c', os.path.join(ROOT, 'gunicorn.conf.py'),
+              '-w', str(args.workers), '-b', bind]
+    threads = runpy.run_path(config[1])['threads']
+    modes = {
+        f'wsgi gthread ({args.workers}x{threads})': [
+            'gunicorn', *config, 'serving:wsgi_app'],
+        f'asgi uvicorn ({args.workers}x1)': [
+            'gunicorn', *config, '-k', 'uvicorn.workers.UvicornH11Worker',
+            'serving:asgi_app']
+    }
+    target = f'http://{bind}/api/v1/movies?page=1&count=none'
+
+    print(f'{args.concurrency} concurrent clients, {args.duration:.0f}s')
+
+    for name, command in modes.items():
+        server = start(command, args.port)
+
+        try:
+            result = asyncio.run(load(target, args.concurrency, args.duration))
+        finally:
+            server.terminate()
+            server.wait()
+
+        print(f'{name:>24}: ' + ', '.join(
+            f'{key} {value:.1f}' for key, value in result.items()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+"""Measures read throughput of the SQLite profile across gunicorn workers.
+
+Serves the same SQLite file with the plain production configuration and
+with the `sqlite` profile (WAL, one writer and a reader pool per worker),
+for each worker count in `--workers`. `--writers` clients keep patching
+actors during the run, which readers in rollback journal mode wait for.
+
+    python benchmarks/bench_sqlite.py --workers 1 2 4 --writers 2
+"""
+import argparse
+import asyncio
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+from bench_serving import load, seed, start  # noqa: E402
+
+HEADERS = {'Authorization': 'Bearer benchmark'}
+
+
+async def write(url, writers, duration):
+    writes = 0
+    errors = 0
+    deadline = time.monotonic() + duration
+
+    async with httpx.AsyncClient(timeout=60) as client:
+        async def writer(actor_id):
+            nonlocal writes, errors
+            while time.monotonic() < deadline:
+                try:
+                    response = await client.patch(
+                        f'{url}/{actor_id}', headers=HEADERS,
+                        json={'name': f'Actor {writes}'})
+                except httpx.TransportError:
+                    errors += 1
+                    continue
+
+                writes += 1
+                errors += response.status_code != 200
+
+        await asyncio.gather(*[writer(i + 1) for i in range(writers)])
+
+    return {'writes/s': writes / duration, 'write errors': errors}
+
+
+async def run(bind, args):
+    reads = load(f'http://{bind}/api/v1/movies?page=1&count=none',
+                 args.concurrency, args.duration)
+
+    if not args.writers:
+        return await reads
+
+    result, written = await asyncio.gather(
+        reads, write(f'http://{bind}/api/v1/actors', args.writers,
+                     args.duration))
+
+    return dict(result, **written)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=200)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4],
+                        help='gunicorn worker counts')
+    parser.add_argument('--writers', type=int, default=0,
+                        help='clients patching actors during the run')
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--port', type=int, default=8765)
+    args = parser.parse_args()
+
+    tmp = tempfile.TemporaryDirectory()
+    path = os.path.join(tmp.name, 'bench.db')
+    os.environ.update({
+        'DATABASE_URL': f'sqlite:///{path}',
+        'SQLITE_PATH': path,
+        'ACCESS_LOG_ENABLED': '0',
+        'PYTHONPATH': os.pathsep.join([ROOT, os.path.join(ROOT, 'benchmarks')])
+    })
+    seed(args.rows)
+
+    bind = f'127.0.0.1:{args.port}'
+
+    print(f'{args.concurrency} concurrent readers, {args.writers} writers, '
+          f'{args.duration:.0f}s')
+
+    for workers in args.workers:
+        for config in ('production', 'sqlite'):
+            # WAL is a property of the file, the plain configuration gets the
+            # default rollback journal back
+            with sqlite3.connect(path) as connection:
+                connection.execute('PRAGMA journal_mode = DELETE')
+
+            os.environ['BENCH_CONFIG'] = config
+            server = start(['gunicorn', '-w', str(workers), '-b', bind,
+                            'serving:wsgi_app'], args.port)
+
+            try:
+                result = asyncio.run(run(bind, args))
+            finally:
+                server.terminate()
+                server.wait()
+
+            name = f'{config} ({workers} workers)'
+            print(f'{name:>24}: ' + ', '.join(
+                f'{key} {value:.1f}' for key, value in result.items()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+"""Measures how long a new worker takes before it can serve requests.
+
+Reports the import time of the management (casting.py) and serving
+(wsgi.py) entry points, the cost of the first token decode that imports
+python-jose, with and without the warm-up the gunicorn workers start in the
+background, and the time from spawning gunicorn to its first response with
+and without gunicorn.conf.py.
+
+    python benchmarks/bench_startup.py --runs 5 --workers 4
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+IMPORT = '''
+import time
+started = time.perf_counter()
+import {module}
+print(time.perf_counter() - started)
+'''
+
+FIRST_DECODE = '''
+import time
+import wsgi
+from app.auth import AuthError, decode_jwt
+started = time.perf_counter()
+try:
+    decode_jwt('e30.e30.', {'keys': []})
+except AuthError:
+    pass
+print(time.perf_counter() - started)
+'''
+
+# a worker starts the warm-up when it boots, its first authenticated request
+# comes in after the first responses
+WARM_DECODE = '''
+import threading
+import time
+import wsgi
+from app.auth import AuthError, decode_jwt, warm_up
+threading.Thread(target=warm_up, daemon=True).start()
+time.sleep({delay})
+started = time.perf_counter()
+try:
+    decode_jwt('e30.e30.', {{'keys': []}})
+except AuthError:
+    pass
+print(time.perf_counter() - started)
+'''
+
+
+def python(code):
+    output = subprocess.check_output([sys.executable, '-c', code], cwd=ROOT,
+                                     env=os.environ)
+    return float(output)
+
+
+def first_response(command, port):
+    started = time.perf_counter()
+    server = subprocess.Popen(command, cwd=ROOT, env=os.environ,
+                              stdout=subprocess.DEVNULL,
+                              stderr=subprocess.DEVNULL)
+
+    try:
+        while time.perf_counter() - started < 60:
+            try:
+                httpx.get(f'http://127.0.0.1:{port}/api/v1/')
+                return time.perf_counter() - started
+            except httpx.TransportError:
+                time.sleep(0.01)
+
+        raise RuntimeError(f'{command[0]} did not start')
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--port', type=int, default=8766)
+    parser.add_argument('--delay', type=float, default=1.5,
+                        help='seconds between the warm-up and the decode')
+    args = parser.parse_args()
+
+    tmp = tempfile.TemporaryDirectory()
+    os.environ.update({
+        'DATABASE_URL': f'sqlite:///{os.path.join(tmp.name, "startup.db")}',
+        'ACCESS_LOG_ENABLED': '0'
+    })
+    python('from wsgi import app\nfrom app import db\n'
+           'with app.app_context(): db.create_all()\nprint(0)')
+
+    bind = ['-w', str(args.workers), '-b', f'127.0.0.1:{args.port}']
+    empty = os.path.join(tmp.name, 'empty.conf.py')
+    open(empty, 'w').close()
+
+    measurements = {
+        'import casting': lambda: python(IMPORT.format(module='casting')),
+        'import wsgi': lambda: python(IMPORT.format(module='wsgi')),
+        'first token decode': lambda: python(FIRST_DECODE),
+        'first token decode, warmed up': lambda: python(
+            WARM_DECODE.format(delay=args.delay)),
+        'gunicorn casting:app': lambda: first_response(
+            ['gunicorn', '-c', empty] + bind + ['casting:app'], args.port),
+        'gunicorn wsgi:app, preloaded': lambda: first_response(
+            ['gunicorn', '-c', 'gunicorn.conf.py'] + bind + ['wsgi:app'],
+            args.port)
+    }
+
+    print(f'median of {args.runs} runs, {args.workers} gunicorn workers')
+
+    for name, measure in measurements.items():
+        timings = [measure() for _ in range(args.runs)]
+        print(f'{name:>30}: {statistics.median(timings) * 1000:8.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,29 @@
+"""Applications for bench_serving.py.
+
+Tokens are accepted without checking their signature, so the comparison
+measures serving rather than the crypto. The signing keys go through the
+shipped cache like in production, only the fetch itself is local.
+BENCH_CONFIG picks the configuration the applications are created with.
+"""
+import os
+
+from app import asgi, auth, create_app
+
+CONFIG = os.getenv('BENCH_CONFIG', 'production')
+PAYLOAD = {'permissions': ['get:movies', 'get:actors', 'patch:actors']}
+
+
+def fetch_jwks():
+    return {}
+
+
+def decode_jwt(token, jwks):
+    return PAYLOAD
+
+
+auth.fetch_jwks = fetch_jwks
+auth.decode_jwt = decode_jwt
+asgi.decode_jwt = decode_jwt
+
+wsgi_app = create_app(CONFIG)
+asgi_app = asgi.AsyncApp(create_app(CONFIG))
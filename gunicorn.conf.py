@@ -0,0 +1,40 @@
+# picked up by gunicorn from the working directory, see the Procfile
+import threading
+
+from app.config import Config
+
+# import the app once in the master, workers fork with it already loaded
+preload_app = True
+
+# the admission limits are per worker, the spare threads take the requests
+# beyond them and reject them instead of leaving them in the backlog. Change
+# streams hold their thread while open, the gthread worker keeps reporting
+# to the arbiter meanwhile so they don't run into the worker timeout
+SPARE_THREADS = 8
+
+worker_class = 'gthread'
+threads = Config.ADMISSION_READ_CONCURRENCY + \
+    Config.ADMISSION_WRITE_CONCURRENCY + \
+    Config.ADMISSION_STREAM_CONCURRENCY + SPARE_THREADS
+
+
+def post_fork(server, worker):
+    from app import dispose_engines
+
+    flask_app = server.app.callable
+
+    if flask_app is None:
+        return
+
+    # the async serving mode wraps the Flask app
+    dispose_engines(getattr(flask_app, 'flask_app', flask_app))
+
+
+def post_worker_init(worker):
+    from app.auth import warm_up
+
+    # importing python-jose takes about a second, in the master it would
+    # delay the first response of every worker. Each worker imports it in
+    # the background instead of on its first authenticated request
+    threading.Thread(target=warm_up, name='casting-warmup',
+                     daemon=True).start()
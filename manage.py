@@ -1,3 +1,6 @@
+import json
+import sys
+
 from flask_script import Manager
 from flask_migrate import Migrate, MigrateCommand
 
@@ -9,5 +12,92 @@ manager = Manager(app)
 manager.add_command('db', MigrateCommand)
 
 
+@manager.option('resource', choices=['movies', 'actors'])
+@manager.option('-f', '--format', dest='fmt', default='csv',
+                choices=['csv', 'ndjson'])
+@manager.option('-o', '--output', dest='output', default=None,
+                help='File to write to, defaults to stdout')
+def export(resource, fmt, output):
+    """Streams movies or actors as CSV or NDJSON"""
+    from app.export import export_chunks
+
+    out = open(output, 'wb') if output else sys.stdout.buffer
+
+    try:
+        for chunk in export_chunks(resource, fmt):
+            out.write(chunk)
+    finally:
+        if output:
+            out.close()
+
+
+@manager.command
+def refresh_stats():
+    """Refreshes the statistics materialized views on PostgreSQL"""
+    from app.stats import materialized, refresh_views
+
+    if not materialized():
+        print('Statistics are only materialized on PostgreSQL')
+        return
+
+    if not refresh_views():
+        print('A refresh is already running')
+
+
+@manager.option('-r', '--rows', dest='rows', type=int, default=100000,
+                help='Movies and actors to seed')
+@manager.option('-t', '--threshold', dest='threshold', type=float,
+                default=0.5, help='Allowed relative growth of the cost')
+@manager.option('-b', '--baseline', dest='baseline', default=None,
+                help='Defaults to query_plans.json')
+@manager.option('-u', '--update', dest='update', action='store_true',
+                help='Write the current plans as the new baseline')
+def check_plans(rows, threshold, baseline, update):
+    """Compares the query plans of the API with the committed baseline"""
+    from app.plans import BASELINE, collect, compare, seq_scans
+
+    if db.engine.dialect.name != 'postgresql':
+        print('Query plans are only checked on PostgreSQL')
+        sys.exit(1)
+
+    baseline = baseline or BASELINE
+    plans = collect(rows)
+
+    for name, statements in plans.items():
+        for plan in statements:
+            print(f'{name}: cost {plan["cost"]}, {plan["ms"]:.2f}ms, '
+                  f'{", ".join(plan["scans"])}')
+
+    if update:
+        problems = seq_scans(plans)
+
+        # a baseline with a sequential scan would never flag it again
+        for problem in problems:
+            print(f'REGRESSION {problem}')
+
+        if problems:
+            sys.exit(1)
+
+        with open(baseline, 'w') as out:
+            json.dump(plans, out, indent=2, sort_keys=True)
+            out.write('\n')
+        return
+
+    try:
+        with open(baseline) as f:
+            known = json.load(f)
+    except FileNotFoundError:
+        print(f'No baseline at {baseline}, create it with --update')
+        sys.exit(1)
+
+    problems = compare(known, plans, threshold)
+
+    for problem in problems:
+        print(f'REGRESSION {problem}')
+
+    if problems:
+        sys.exit(1)
+
+
 if __name__ == '__main__':
     manager.run()
@@ -0,0 +1,63 @@
+"""statistics views
+
+Revision ID: 5d7b3e21f8a0
+Revises: a92e5b04c6d1
+Create Date: 2026-10-19 14:03:55.116402
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '5d7b3e21f8a0'
+down_revision = 'a92e5b04c6d1'
+branch_labels = None
+depends_on = None
+
+# keep in sync with the aggregates in app/stats.py
+VIEWS = {
+    'stats_movies_per_year': '''
+        SELECT coalesce(CAST(CAST(EXTRACT(year FROM release_date) AS INTEGER)
+                        AS VARCHAR), 'unknown') AS key,
+               count(*) AS count
+        FROM "Movie" GROUP BY 1
+    ''',
+    'stats_cast_sizes': '''
+        SELECT CAST(sizes.size AS VARCHAR) AS key, count(*) AS count
+        FROM (SELECT count(association.actor_id) AS size
+              FROM "Movie" LEFT OUTER JOIN association
+              ON "Movie".id = association.movie_id
+              GROUP BY "Movie".id) AS sizes
+        GROUP BY 1
+    ''',
+    'stats_actors_by_gender': '''
+        SELECT coalesce(gender, 'unknown') AS key, count(*) AS count
+        FROM "Actor" GROUP BY 1
+    ''',
+    'stats_actors_by_age': '''
+        SELECT coalesce(CAST(age / 10 * 10 AS VARCHAR) || '-' ||
+                        CAST(age / 10 * 10 + 9 AS VARCHAR), 'unknown') AS key,
+               count(*) AS count
+        FROM "Actor" GROUP BY 1
+    '''
+}
+
+
+def upgrade():
+    # materialized views only exist on PostgreSQL, other databases compute
+    # the aggregates on the fly
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+
+    for name, query in VIEWS.items():
+        op.execute(f'CREATE MATERIALIZED VIEW {name} AS {query}')
+        # REFRESH ... CONCURRENTLY needs a unique index
+        op.execute(f'CREATE UNIQUE INDEX ix_{name}_key ON {name} (key)')
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+
+    for name in VIEWS:
+        op.execute(f'DROP MATERIALIZED VIEW {name}')
@@ -1,12 +1,24 @@
+import asyncio
+import gzip
 import json
+import os
+import runpy
+import tempfile
+import threading
 from functools import wraps
 from datetime import datetime
 from mock import patch
 import unittest
 from flask import request, abort
+from sqlalchemy import create_engine, event
 
-from app.models import Movie, Actor
-from app import create_app, db
+from app.models import (Movie, Actor, Job, Change, association_table,
+                        delete_rows)
+from app.changes import changes_since
+from app.graph import CastIndex
+from app.jobs import JobContext
+from app import create_app, db, dispose_engines
+from app.config import SQLiteConfig, TestingConfig
 
 API_PREFIX = '/api/v1'
 
@@ -58,7 +70,12 @@ def mock_requires_auth(permission=''):
                 "permissions": ROLES[role_name]["permissions"]
             }
 
+            if "SUB" in request.headers:
+                payload["sub"] = request.headers["SUB"]
+
             check_permissions(permission, payload)
+            request.environ['casting.subject'] = payload.get('sub')
+            limit_subject(payload)
             return f(payload, *args, **kwargs)
 
         return wrapper
@@ -67,7 +84,12 @@ def mock_requires_auth(permission=''):
 
 patch('app.auth.requires_auth', mock_requires_auth).start()
 
-from app.auth import check_permissions, AuthError  # noqa
+from app.auth import (check_permissions, AuthError, SigningKeys,  # noqa
+                      verify_decode_jwt)
+from app.admission import limit_subject  # noqa
+from app.asgi import AsyncApp  # noqa
+from app.queries import prepared  # noqa
+from app import plans, queries  # noqa
 
 
 class CastingTestCase(unittest.TestCase):
@@ -112,6 +134,33 @@ class CastingTestCase(unittest.TestCase):
         self.assertEqual(data['success'], True)
         self.assertEqual(data['movies'], [movie.format()])
 
+    def test_get_movies_paginated(self):
+        movies = [Movie(title='First'), Movie(title='Second')]
+        for movie in movies:
+            movie.insert()
+
+        res = self.client().get(f'{API_PREFIX}/movies?page=2&per_page=1',
+                                headers={"ROLE": "CASTING_ASSISTANT"})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['movies'], [movies[1].format()])
+        self.assertEqual(data['total'], 2)
+
+        for count, total in (('estimated', 2), ('none', None)):
+            res = self.client().get(
+                f'{API_PREFIX}/movies?page=1&count={count}',
+                headers={"ROLE": "CASTING_ASSISTANT"})
+            data = json.loads(res.data)
+
+            self.assertEqual(data.get('total'), total)
+
+    def test_get_movies_400(self):
+        res = self.client().get(f'{API_PREFIX}/movies?count=some',
+                                headers={"ROLE": "CASTING_ASSISTANT"})
+
+        self.assertEqual(res.status_code, 400)
+
     def test_get_movies_404(self):
         res = self.client().get(f'{API_PREFIX}/movies',
                                 headers={"ROLE": "CASTING_ASSISTANT"})
@@ -148,6 +197,79 @@ class CastingTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 422)
         self.assertEqual(data['success'], False)
 
+    def test_post_movies_422_fields(self):
+        actor = Actor(name='Test')
+        actor.insert()
+
+        res = self.client().post(f'{API_PREFIX}/movies', json={
+            'release_date': '04.12.2012', 'actors': [actor.id]
+        }, headers={"ROLE": "EXECUTIVE_PRODUCER"})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['errors'], {
+            'title': 'Is required',
+            'release_date': 'Must be a date formatted as YYYY-MM-DD'
+        })
+
+        res = self.client().post(f'{API_PREFIX}/movies', json={
+            'title': 'Title', 'actors': [actor.id, 9998, 9999]
+        }, headers={"ROLE": "EXECUTIVE_PRODUCER"})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['errors'], {'actors': 'Unknown ids: 9998, 9999'})
+        self.assertEqual(Movie.query.count(), 0)
+
+    def test_prepared_statement(self):
+        name, prepare, execute = prepared(
+            'SELECT "Movie".id FROM "Movie" WHERE "Movie".id IN '
+            '(%(ids_1)s, %(ids_2)s) LIMIT %(limit)s OFFSET %(ids_1)s')
+
+        self.assertTrue(name.startswith('casting_'))
+        self.assertEqual(prepare, f'PREPARE {name} AS SELECT "Movie".id '
+                         'FROM "Movie" WHERE "Movie".id IN ($1, $2) '
+                         'LIMIT $3 OFFSET $1')
+        self.assertEqual(execute, f'EXECUTE {name}'
+                         '(%(ids_1)s, %(ids_2)s, %(limit)s)')
+
+    def test_compare_plans(self):
+        movie = Movie(title='Test')
+        movie.insert()
+        sample = {'movie': movie.id}
+
+        self.assertEqual(len(plans.capture(lambda: plans.cast(sample))), 2)
+
+        plan = {'Node Type': 'Nested Loop', 'Total Cost': 20.5, 'Plans': [
+            {'Node Type': 'Index Scan', 'Relation Name': 'Actor',
+             'Index Name': 'Actor_pkey'},
+            {'Node Type': 'Seq Scan', 'Relation Name': 'association'}
+        ]}
+        scans = plans.scans(plan)
+        baseline = {'movie cast': [{'cost': 10, 'scans': scans[:1]}],
+                    'get movie': [{'cost': 8, 'scans': []}]}
+
+        self.assertEqual(scans, ['Index Scan on Actor using Actor_pkey',
+                                 'Seq Scan on association'])
+        self.assertEqual(plans.compare(baseline, {
+            'movie cast': [{'cost': 20.5, 'scans': scans}],
+            'get movie': [{'cost': 8, 'scans': []}] * 2,
+            'costars': [{'cost': 1, 'scans': []}]
+        }, 0.5), ['movie cast: Seq Scan on association',
+                  'movie cast: cost 10 -> 20.5',
+                  'get movie: 2 statements, 1 in the baseline',
+                  'costars: not in the baseline'])
+
+        # a sequential scan the baseline has as well is still reported
+        baseline['movie cast'][0]['scans'] = scans
+        current = {'movie cast': [{'cost': 10, 'scans': scans}]}
+
+        self.assertEqual(plans.compare(baseline, current, 0.5),
+                         ['movie cast: Seq Scan on association'])
+
+        with patch.dict(plans.SEQ_SCANS, {'movie cast': ['association']}):
+            self.assertEqual(plans.compare(baseline, current, 0.5), [])
+
     def test_post_movies_401(self):
         res = self.client().post(f'{API_PREFIX}/movies', json=self.new_movie)
         data = json.loads(res.data)
@@ -179,6 +301,58 @@ class CastingTestCase(unittest.TestCase):
         self.assertEqual(data['success'], True)
         self.assertEqual(self.update_movie['title'], data['movie']['title'])
 
+    def test_patch_movies_if_match(self):
+        movie = Movie(title='Test')
+        movie.insert()
+
+        res = self.client().patch(f'{API_PREFIX}/movies/{movie.id}',
+                                  json=self.update_movie,
+                                  headers={"ROLE": "CASTING_DIRECTOR",
+                                           "If-Match": '"1"'})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['movie']['version'], 2)
+        self.assertEqual(res.headers['ETag'], '"2"')
+
+    def test_patch_movies_412(self):
+        movie = Movie(title='Test')
+        movie.insert()
+        movie.title = 'Changed'
+        movie.update()
+
+        res = self.client().patch(f'{API_PREFIX}/movies/{movie.id}',
+                                  json=self.update_movie,
+                                  headers={"ROLE": "CASTING_DIRECTOR",
+                                           "If-Match": '"1"'})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 412)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], "Precondition failed")
+        self.assertEqual(Movie.query.get(movie.id).title, 'Changed')
+
+    def test_patch_movies_cast_only_version(self):
+        movie = Movie(title='Test')
+        movie.insert()
+        actor = Actor(name='Test')
+        actor.insert()
+
+        res = self.client().patch(f'{API_PREFIX}/movies/{movie.id}', json={
+            'title': 'Test',
+            'actors': [actor.id]
+        }, headers={"ROLE": "CASTING_DIRECTOR", "If-Match": '"1"'})
+        data = json.loads(res.data)
+
+        self.assertEqual(data['movie']['actors'], [actor.id])
+        self.assertEqual(data['movie']['version'], 2)
+
+        res = self.client().patch(f'{API_PREFIX}/movies/{movie.id}', json={
+            'title': 'Test'
+        }, headers={"ROLE": "CASTING_DIRECTOR", "If-Match": '"1"'})
+
+        self.assertEqual(res.status_code, 412)
+
     def test_patch_movies_401(self):
         res = self.client().patch(
             f'{API_PREFIX}/movies/9999', json=self.update_movie)
@@ -249,6 +423,95 @@ class CastingTestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], "Resource was not found")
 
+    def test_delete_many_movies(self):
+        actor = Actor(name='Test')
+        actor.insert()
+        movies = [Movie(title='First', actors=[actor]),
+                  Movie(title='Second', actors=[actor]), Movie(title='Kept')]
+
+        for movie in movies:
+            movie.insert()
+
+        ids = [movies[0].id, movies[1].id]
+        res = self.client().delete(f'{API_PREFIX}/movies',
+                                   json={'ids': ids + [9999]},
+                                   headers={"ROLE": "EXECUTIVE_PRODUCER"})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['deleted'], ids)
+        self.assertEqual([m.title for m in Movie.query], ['Kept'])
+        self.assertEqual(Actor.query.count(), 1)
+        self.assertEqual(db.session.query(association_table).count(), 0)
+        self.assertEqual(
+            Change.query.filter_by(resource='movie', action='delete').count(),
+            2)
+
+    def test_delete_rows_locks_change_log_first(self):
+        movie = Movie(title='Test')
+        movie.insert()
+        movie_id = movie.id
+        order = []
+
+        def statement(*args):
+            order.append('statement')
+
+        event.listen(db.engine, 'before_cursor_execute', statement)
+
+        try:
+            # update() takes the change log lock before its row lock, so
+            # must a delete of the same row
+            with patch('app.models.lock_changes',
+                       side_effect=lambda: order.append('lock')):
+                delete_rows(Movie, [movie_id])
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', statement)
+
+        self.assertEqual(order[0], 'lock')
+        self.assertEqual(order.count('lock'), 1)
+
+    def test_delete_many_movies_404(self):
+        res = self.client().delete(f'{API_PREFIX}/movies',
+                                   json={'ids': [9999]},
+                                   headers={"ROLE": "EXECUTIVE_PRODUCER"})
+
+        self.assertEqual(res.status_code, 404)
+
+    def test_delete_many_actors_updates_casts(self):
+        actors = [Actor(name='First'), Actor(name='Second'),
+                  Actor(name='Kept')]
+
+        for actor in actors:
+            actor.insert()
+
+        movie = Movie(title='Test', actors=actors)
+        movie.insert()
+        ids = [actors[0].id, actors[1].id]
+
+        with patch('app.models.CHUNK_SIZE', 1):
+            res = self.client().delete(f'{API_PREFIX}/actors',
+                                       json={'ids': ids},
+                                       headers={"ROLE": "CASTING_DIRECTOR"})
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(movie.actors, [actors[2]])
+        self.assertEqual(movie.version, 2)
+        self.assertEqual(
+            [(c.resource, c.resource_id) for c in Change.query.filter_by(
+                action='update')], [('movie', movie.id)])
+
+    def test_delete_many_actors_422(self):
+        self.app.config['MAX_DELETE_IDS'] = 2
+
+        for ids in ([1, 'a'], [1, 2, 3]):
+            res = self.client().delete(f'{API_PREFIX}/actors',
+                                       json={'ids': ids},
+                                       headers={"ROLE": "CASTING_DIRECTOR"})
+            data = json.loads(res.data)
+
+            self.assertEqual(res.status_code, 422)
+            self.assertIn('ids', data['errors'])
+
     def test_get_actors(self):
         actor = Actor(name='Test')
         actor.insert()
@@ -318,6 +581,19 @@ class CastingTestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], "Forbidden")
 
+    def test_patch_actors_422(self):
+        actor = Actor(name='Test')
+        actor.insert()
+
+        res = self.client().patch(f'{API_PREFIX}/actors/{actor.id}',
+                                  json={'name': 'Name', 'age': '30'},
+                                  headers={"ROLE": "CASTING_DIRECTOR"})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['errors'], {'age': 'Must be an integer'})
+
     def test_patch_actors(self):
         actor = Actor(name='Test')
 
@@ -376,6 +652,17 @@ class CastingTestCase(unittest.TestCase):
         self.assertEqual(data['success'], True)
         self.assertEqual(data['deleted'], actor.id)
 
+    def test_delete_actors_412(self):
+        actor = Actor(name='Test')
+        actor.insert()
+
+        res = self.client().delete(
+            f'{API_PREFIX}/actors/{actor.id}',
+            headers={"ROLE": "CASTING_DIRECTOR", "If-Match": '"7"'})
+
+        self.assertEqual(res.status_code, 412)
+        self.assertEqual(Actor.query.count(), 1)
+
     def test_delete_actors_401(self):
         res = self.client().delete(f'{API_PREFIX}/actors/9999')
         data = json.loads(res.data)
@@ -402,6 +689,1047 @@ class CastingTestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], "Resource was not found")
 
+    def test_get_changes(self):
+        movie = Movie(title='Test')
+        movie.insert()
+        movie.title = 'Patched'
+        movie.update()
+        actor = Actor(name='Test')
+        actor.insert()
+        actor_id = actor.id
+        actor.delete()
+
+        res = self.client().get(f'{API_PREFIX}/changes',
+                                headers={"ROLE": "CASTING_ASSISTANT"})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(
+            [(c['resource'], c['id'], c['action']) for c in data['changes']],
+            [('movie', movie.id, 'create'), ('movie', movie.id, 'update'),
+             ('actor', actor_id, 'create'), ('actor', actor_id, 'delete')])
+        self.assertEqual(data['changes'][1]['data']['title'], 'Patched')
+        self.assertNotIn('data', data['changes'][3])
+
+        res = self.client().get(f'{API_PREFIX}/changes?since={data["cursor"]}',
+                                headers={"ROLE": "CASTING_ASSISTANT"})
+        data = json.loads(res.data)
+
+        self.assertEqual(data['changes'], [])
+
+    def test_changes_load_casts_in_one_query(self):
+        actor = Actor(name='Test')
+        actor.insert()
+
+        for i in range(5):
+            Movie(title=f'Title {i}', actors=[actor]).insert()
+
+        statements = plans.capture(lambda: changes_since(0, 500))
+
+        # the changes, then the movies and actors, then the casts
+        self.assertEqual(len(statements), 4)
+
+    def test_get_changes_400(self):
+        res = self.client().get(f'{API_PREFIX}/changes?since=abc',
+                                headers={"ROLE": "CASTING_ASSISTANT"})
+
+        self.assertEqual(res.status_code, 400)
+
+    def test_stream_changes(self):
+        movie = Movie(title='Test')
+        movie.insert()
+
+        res = self.client().get(f'{API_PREFIX}/changes/stream',
+                                headers={"ROLE": "CASTING_ASSISTANT"})
+        chunk = next(iter(res.response))
+        res.close()
+
+        self.assertEqual(res.mimetype, 'text/event-stream')
+        self.assertIn(b'event: change', chunk)
+        self.assertIn(b'"action": "create"', chunk)
+
+    def test_stream_changes_ends(self):
+        Movie(title='Test').insert()
+        self.app.config['CHANGES_STREAM_SECONDS'] = 0
+        admission = self.app.extensions['admission']
+        admission.queue_timeout = 0
+
+        # streams have their own slots and don't wait for reads
+        while admission.slots['read'].acquire(timeout=0):
+            pass
+
+        res = self.client().get(f'{API_PREFIX}/changes/stream',
+                                headers={"ROLE": "CASTING_ASSISTANT"})
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.data.count(b'event: change'), 1)
+
+    def test_get_stats(self):
+        self.create_cast()
+        Movie(title='Dated', release_date=datetime(2012, 12, 4)).insert()
+        Actor(name='Aged', age=34, gender='female').insert()
+
+        res = self.client().get(f'{API_PREFIX}/stats',
+                                headers={"ROLE": "CASTING_ASSISTANT"})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['stats'], {
+            'movies_per_year': {'2012': 1, 'unknown': 2},
+            'cast_sizes': {'0': 1, '2': 2},
+            'actors_by_gender': {'female': 1, 'unknown': 4},
+            'actors_by_age': {'30-39': 1, 'unknown': 4}
+        })
+
+    def create_cast(self):
+        actors = [Actor(name=name) for name in ('A', 'B', 'C', 'D')]
+        for actor in actors:
+            actor.insert()
+
+        movies = [Movie(title='First', actors=actors[0:2]),
+                  Movie(title='Second', actors=actors[1:3])]
+        for movie in movies:
+            movie.insert()
+
+        return actors, movies
+
+    def test_get_costars(self):
+        actors, movies = self.create_cast()
+
+        res = self.client().get(f'{API_PREFIX}/actors/{actors[1].id}/costars',
+                                headers={"ROLE": "CASTING_ASSISTANT"})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['costars'], [actors[0].id, actors[2].id])
+
+    def test_get_costars_404(self):
+        res = self.client().get(f'{API_PREFIX}/actors/9999/costars',
+                                headers={"ROLE": "CASTING_ASSISTANT"})
+
+        self.assertEqual(res.status_code, 404)
+
+    def test_get_actor_path(self):
+        actors, movies = self.create_cast()
+        source, target = actors[0].id, actors[3].id
+
+        res = self.client().get(f'{API_PREFIX}/actors/{source}/path/{target}',
+                                headers={"ROLE": "CASTING_ASSISTANT"})
+
+        self.assertEqual(res.status_code, 404)
+
+        movies[1].actors.append(actors[3])
+        movies[1].update()
+
+        res = self.client().get(f'{API_PREFIX}/actors/{source}/path/{target}',
+                                headers={"ROLE": "CASTING_ASSISTANT"})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['path'], [source, actors[1].id, target])
+        self.assertEqual(data['movies'], [movies[0].id, movies[1].id])
+        self.assertEqual(data['degrees'], 2)
+
+    def test_get_actor_path_without_index(self):
+        del self.app.extensions['costars']
+        actors, movies = self.create_cast()
+        source, target = actors[2].id, actors[0].id
+
+        res = self.client().get(f'{API_PREFIX}/actors/{source}/path/{target}',
+                                headers={"ROLE": "CASTING_ASSISTANT"})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['path'], [source, actors[1].id, target])
+        self.assertEqual(data['movies'], [movies[1].id, movies[0].id])
+
+    def test_export_movies(self):
+        actor = Actor(name='Test')
+        actor.insert()
+        movie = Movie(title='Test', release_date=datetime(2012, 12, 4))
+        movie.actors = [actor]
+        movie.insert()
+
+        res = self.client().get(f'{API_PREFIX}/export/movies',
+                                headers={"ROLE": "CASTING_ASSISTANT"})
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'text/csv')
+        self.assertEqual(res.data.decode().splitlines(), [
+            'id,title,release_date,actor_id',
+            f'{movie.id},Test,2012-12-04,{actor.id}'
+        ])
+
+    def test_export_actors_ndjson(self):
+        actor = Actor(name='Test', age=30)
+        actor.insert()
+
+        res = self.client().get(f'{API_PREFIX}/export/actors?format=ndjson',
+                                headers={"ROLE": "CASTING_ASSISTANT"})
+        lines = res.data.decode().splitlines()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        self.assertEqual([json.loads(line) for line in lines], [{
+            'id': actor.id, 'name': 'Test', 'age': 30, 'gender': None,
+            'movie_id': None
+        }])
+
+    def test_get_movies_gzip(self):
+        for i in range(50):
+            Movie(title=f'Title {i}').insert()
+
+        plain = self.client().get(f'{API_PREFIX}/movies',
+                                  headers={"ROLE": "CASTING_ASSISTANT"})
+
+        for _ in range(2):
+            res = self.client().get(f'{API_PREFIX}/movies',
+                                    headers={"ROLE": "CASTING_ASSISTANT",
+                                             "Accept-Encoding": "gzip"})
+
+            self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+            self.assertIn('Accept-Encoding', res.headers['Vary'])
+            self.assertEqual(gzip.decompress(res.data), plain.data)
+
+        # the second response came from the cache
+        self.assertEqual(len(self.app.extensions['compression'].cache), 1)
+
+        res = self.client().get(f'{API_PREFIX}/movies?page=1&per_page=1',
+                                headers={"ROLE": "CASTING_ASSISTANT",
+                                         "Accept-Encoding": "gzip"})
+
+        self.assertNotIn('Content-Encoding', res.headers)
+
+    def test_export_movies_gzip(self):
+        Movie(title='Test').insert()
+
+        res = self.client().get(f'{API_PREFIX}/export/movies',
+                                headers={"ROLE": "CASTING_ASSISTANT",
+                                         "Accept-Encoding": "gzip"})
+
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertNotIn('Content-Length', res.headers)
+        self.assertEqual(gzip.decompress(res.data).decode().splitlines(), [
+            'id,title,release_date,actor_id',
+            f'{Movie.query.first().id},Test,,'
+        ])
+
+    def test_export_400(self):
+        res = self.client().get(f'{API_PREFIX}/export/movies?format=xml',
+                                headers={"ROLE": "CASTING_ASSISTANT"})
+
+        self.assertEqual(res.status_code, 400)
+
+    def test_import_movies_job(self):
+        res = self.client().post(f'{API_PREFIX}/movies/jobs', json={
+            'operation': 'import',
+            'items': [self.new_movie, {'title': 'Other'}]
+        }, headers={"ROLE": "EXECUTIVE_PRODUCER"})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 202)
+        self.assertEqual(data['success'], True)
+
+        res = self.client().get(
+            f'{API_PREFIX}/movies/jobs/{data["job"]["id"]}',
+            headers={"ROLE": "CASTING_ASSISTANT"})
+        data = json.loads(res.data)
+
+        self.assertEqual(data['job']['status'], 'succeeded')
+        self.assertEqual(data['job']['progress'], 2)
+        self.assertEqual(data['job']['result'],
+                         {'imported': 2, 'errors': []})
+        self.assertEqual(Movie.query.count(), 2)
+
+    def test_import_movies_job_item_errors(self):
+        actor = Actor(name='Test')
+        actor.insert()
+        self.app.extensions['jobs'].batch_size = 2
+
+        with patch('app.queries.by_ids', wraps=queries.by_ids) as by_ids:
+            res = self.client().post(f'{API_PREFIX}/movies/jobs', json={
+                'operation': 'import',
+                'items': [self.invalid_movie,
+                          {'title': 'Cast', 'actors': [actor.id]},
+                          {'title': 'Unknown', 'actors': [actor.id, 9999]},
+                          {'title': 'Other', 'release_date': 'soon'}]
+            }, headers={"ROLE": "EXECUTIVE_PRODUCER"})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 202)
+        self.assertEqual(data['job']['status'], 'succeeded')
+        self.assertEqual(data['job']['result'], {'imported': 1, 'errors': [
+            {'index': 0, 'errors': {'title': 'Is required'}},
+            {'index': 2, 'errors': {'actors': 'Unknown ids: 9999'}},
+            {'index': 3, 'errors': {
+                'release_date': 'Must be a date formatted as YYYY-MM-DD'}}
+        ]})
+        self.assertEqual([m.actors for m in Movie.query], [[actor]])
+        # one lookup of the referenced actors per batch
+        self.assertEqual(by_ids.call_count, 2)
+
+    def test_import_movies_job_403(self):
+        res = self.client().post(f'{API_PREFIX}/movies/jobs', json={
+            'operation': 'import',
+            'items': [self.new_movie]
+        }, headers={"ROLE": "CASTING_DIRECTOR"})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 403)
+        self.assertEqual(data['message'], "Forbidden")
+
+    def test_delete_actors_job(self):
+        actor = Actor(name='Test')
+        actor.insert()
+
+        res = self.client().post(f'{API_PREFIX}/actors/jobs', json={
+            'operation': 'delete',
+            'ids': [actor.id]
+        }, headers={"ROLE": "CASTING_DIRECTOR"})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 202)
+        self.assertEqual(data['job']['status'], 'succeeded')
+        self.assertEqual(Actor.query.count(), 0)
+
+    def test_export_actors_job(self):
+        actor = Actor(name='Test')
+        actor.insert()
+
+        res = self.client().post(f'{API_PREFIX}/actors/jobs', json={
+            'operation': 'export',
+            'format': 'csv'
+        }, headers={"ROLE": "CASTING_ASSISTANT"})
+        data = json.loads(res.data)
+
+        self.assertEqual(data['job']['status'], 'succeeded')
+
+        res = self.client().get(
+            f'{API_PREFIX}/actors/jobs/{data["job"]["id"]}/result',
+            headers={"ROLE": "CASTING_ASSISTANT"})
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.data.decode().splitlines()[1],
+                         f'{actor.id},Test,,,')
+        res.close()
+
+    def test_cancel_job(self):
+        job = Job(resource='movies', operation='delete', status='running',
+                  params='{"ids": []}')
+        job.insert()
+
+        res = self.client().delete(f'{API_PREFIX}/movies/jobs/{job.id}',
+                                   headers={"ROLE": "EXECUTIVE_PRODUCER"})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['job']['status'], 'cancelling')
+
+        res = self.client().delete(f'{API_PREFIX}/movies/jobs/{job.id}',
+                                   headers={"ROLE": "EXECUTIVE_PRODUCER"})
+
+        self.assertEqual(res.status_code, 422)
+
+    def test_get_job_404(self):
+        res = self.client().get(f'{API_PREFIX}/movies/jobs/9999',
+                                headers={"ROLE": "CASTING_ASSISTANT"})
+
+        self.assertEqual(res.status_code, 404)
+
+    def test_recover_jobs(self):
+        job = Job(resource='actors', operation='import', status='running',
+                  params=json.dumps({'items': [self.new_actor]}),
+                  updated_at=datetime(2020, 1, 1))
+        job.insert()
+
+        self.app.extensions['jobs'].recover()
+        db.session.refresh(job)
+
+        self.assertEqual(job.status, 'succeeded')
+        self.assertEqual(Actor.query.count(), 1)
+
+    def test_recover_fresh_job_once_stale(self):
+        job = Job(resource='actors', operation='import', status='running',
+                  params=json.dumps({'items': [self.new_actor]}),
+                  updated_at=datetime.utcnow())
+        job.insert()
+        runner = self.app.extensions['jobs']
+
+        runner.recover()
+        db.session.refresh(job)
+
+        self.assertEqual(job.status, 'running')
+
+        # the heartbeat stopped longer ago than JOBS_STALE_AFTER
+        runner.stale_after = -60
+        runner.recover()
+        db.session.refresh(job)
+
+        self.assertEqual(job.status, 'succeeded')
+
+    def test_recover_periodically(self):
+        runner = self.app.extensions['jobs']
+        runner.recover_interval = 0.01
+        calls = []
+        recovered = threading.Event()
+
+        def recover():
+            calls.append(True)
+
+            if len(calls) > 2:
+                recovered.set()
+
+        with patch.object(runner, 'recover', side_effect=recover):
+            runner.start()
+            self.assertTrue(recovered.wait(5))
+            runner.stopped.set()
+            runner.recoverer.join(5)
+
+    def test_job_heartbeat(self):
+        job = Job(resource='movies', operation='export', status='running',
+                  params='{"format": "csv"}', updated_at=datetime(2020, 1, 1))
+        job.insert()
+
+        JobContext(job, 500).heartbeat()
+        db.session.refresh(job)
+
+        self.assertGreater(job.updated_at, datetime(2020, 1, 1))
+
+    def test_purge_exports(self):
+        runner = self.app.extensions['jobs']
+
+        with tempfile.TemporaryDirectory() as directory:
+            runner.export_dir = directory
+            old = os.path.join(directory, 'job-1.csv')
+            new = os.path.join(directory, 'job-2.csv')
+
+            for path in (old, new):
+                open(path, 'w').close()
+
+            os.utime(old, (0, 0))
+            runner.purge_exports()
+
+            self.assertFalse(os.path.exists(old))
+            self.assertTrue(os.path.exists(new))
+
+    def test_purged_export_result_404(self):
+        job = Job(resource='movies', operation='export', status='succeeded',
+                  params='{"format": "csv"}', result=json.dumps({
+                      'path': '/nonexistent/job-1.csv', 'format': 'csv',
+                      'size': 0}))
+        job.insert()
+
+        res = self.client().get(f'{API_PREFIX}/movies/jobs/{job.id}/result',
+                                headers={"ROLE": "CASTING_ASSISTANT"})
+
+        self.assertEqual(res.status_code, 404)
+
+    def test_rate_limit_429(self):
+        self.app.extensions['admission'].burst = 1
+        headers = {"ROLE": "CASTING_ASSISTANT", "SUB": "auth0|test"}
+
+        self.client().get(f'{API_PREFIX}/movies', headers=headers)
+        res = self.client().get(f'{API_PREFIX}/movies', headers=headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 429)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], "Too many requests")
+        self.assertTrue(int(res.headers['Retry-After']) >= 1)
+
+    def test_overload_503(self):
+        admission = self.app.extensions['admission']
+        admission.queue_timeout = 0
+
+        while admission.slots['read'].acquire(timeout=0):
+            pass
+
+        res = self.client().get(f'{API_PREFIX}/movies',
+                                headers={"ROLE": "CASTING_ASSISTANT"})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 503)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(res.headers['Retry-After'], '1')
+
+        res = self.client().post(f'{API_PREFIX}/actors', json=self.new_actor,
+                                 headers={"ROLE": "EXECUTIVE_PRODUCER"})
+
+        self.assertEqual(res.status_code, 200)
+
+    def test_concurrent_overload_503(self):
+        admission = self.app.extensions['admission']
+        admission.slots['read'] = threading.BoundedSemaphore(1)
+        admission.queue_timeout = 0
+        entered, release = threading.Event(), threading.Event()
+
+        def slow_listing(model, offset=None, limit=None):
+            entered.set()
+            release.wait(5)
+            return []
+
+        with patch('app.queries.listing', slow_listing):
+            first = threading.Thread(target=lambda: self.client().get(
+                f'{API_PREFIX}/movies', headers={"ROLE": "CASTING_ASSISTANT"}))
+            first.start()
+            entered.wait(5)
+
+            res = self.client().get(f'{API_PREFIX}/actors',
+                                    headers={"ROLE": "CASTING_ASSISTANT"})
+            release.set()
+            first.join()
+
+        self.assertEqual(res.status_code, 503)
+
+    def test_gunicorn_threads_exceed_admission(self):
+        settings = runpy.run_path('gunicorn.conf.py')
+
+        self.assertEqual(settings['worker_class'], 'gthread')
+        self.assertGreater(settings['threads'],
+                           TestingConfig.ADMISSION_READ_CONCURRENCY +
+                           TestingConfig.ADMISSION_WRITE_CONCURRENCY +
+                           TestingConfig.ADMISSION_STREAM_CONCURRENCY)
+
+    def test_signing_keys_cached(self):
+        keys = {'keys': []}
+
+        with patch('app.auth.fetch_jwks', return_value=keys) as fetch:
+            signing_keys = SigningKeys()
+
+            self.assertIs(signing_keys.get(600), keys)
+            self.assertIs(signing_keys.get(600), keys)
+            fetch.assert_called_once_with()
+
+            signing_keys.expires = 0
+            signing_keys.get(600)
+
+        self.assertEqual(fetch.call_count, 2)
+
+    def test_verify_decode_jwt_uses_cached_keys(self):
+        # the WSGI fallback of the async app verifies tokens this way
+        with patch('app.auth.signing_keys', SigningKeys()), \
+                patch('app.auth.decode_jwt') as decode, \
+                patch('app.auth.fetch_jwks', return_value={'keys': []}) \
+                as fetch:
+            verify_decode_jwt('first')
+            verify_decode_jwt('second')
+
+        fetch.assert_called_once_with()
+        self.assertEqual(decode.call_count, 2)
+
+
+class ReplicaRoutingTestCase(unittest.TestCase):
+    """This class runs the API against a primary and a replica database"""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        primary = f'sqlite:///{os.path.join(self.tmp.name, "primary.db")}'
+        replica = f'sqlite:///{os.path.join(self.tmp.name, "replica.db")}'
+
+        self.app = create_app('testing')
+        self.app.config['SQLALCHEMY_DATABASE_URI'] = primary
+        self.app.config['SQLALCHEMY_REPLICA_URIS'] = [replica]
+        self.client = self.app.test_client()
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+        self.replica = create_engine(replica)
+        db.metadata.create_all(self.replica)
+        self.replica.execute(Movie.__table__.insert(),
+                             title='Replicated', version=1)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.replica.dispose()
+        self.app.extensions['replicas'].dispose()
+        self.app_context.pop()
+        self.tmp.cleanup()
+
+    def test_get_reads_from_replica(self):
+        res = self.client.get(f'{API_PREFIX}/movies',
+                              headers={"ROLE": "CASTING_ASSISTANT"})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([m['title'] for m in data['movies']], ['Replicated'])
+
+    def test_reads_stick_to_primary_after_write(self):
+        res = self.client.post(f'{API_PREFIX}/movies',
+                               json={'title': 'Written',
+                                     'release_date': '2012-12-04'},
+                               headers={"ROLE": "EXECUTIVE_PRODUCER"})
+
+        self.assertEqual(res.status_code, 200)
+
+        res = self.client.get(f'{API_PREFIX}/movies',
+                              headers={"ROLE": "CASTING_ASSISTANT"})
+        data = json.loads(res.data)
+
+        self.assertEqual([m['title'] for m in data['movies']], ['Written'])
+
+    def titles(self, client, headers):
+        res = client.get(f'{API_PREFIX}/movies',
+                         headers=dict(headers, ROLE="CASTING_ASSISTANT"))
+        return [m['title'] for m in json.loads(res.data)['movies']]
+
+    def test_reads_stick_to_primary_by_subject(self):
+        client = self.app.test_client(use_cookies=False)
+        client.post(f'{API_PREFIX}/movies', json={'title': 'Written'},
+                    headers={"ROLE": "EXECUTIVE_PRODUCER", "SUB": "auth0|a"})
+
+        self.assertEqual(self.titles(client, {"SUB": "auth0|a"}),
+                         ['Written'])
+        self.assertEqual(self.titles(client, {"SUB": "auth0|b"}),
+                         ['Replicated'])
+
+    def test_reads_stick_to_primary_by_header(self):
+        client = self.app.test_client(use_cookies=False)
+        res = client.post(f'{API_PREFIX}/movies', json={'title': 'Written'},
+                          headers={"ROLE": "EXECUTIVE_PRODUCER"})
+        until = res.headers['Casting-Primary-Until']
+
+        self.assertEqual(self.titles(client, {"Casting-Primary-Until": until}),
+                         ['Written'])
+        self.assertEqual(self.titles(client, {}), ['Replicated'])
+
+    def test_requests_do_not_ping_replicas(self):
+        Movie(title='Primary').insert()
+        replicas = self.app.extensions['replicas']
+        replicas.setup()
+
+        with patch.object(replicas, 'ping') as ping:
+            self.assertEqual(self.titles(self.client, {}), ['Replicated'])
+
+        ping.assert_not_called()
+
+        with patch.object(replicas, 'ping', side_effect=Exception('down')):
+            replicas.check()
+
+        self.assertEqual(self.titles(self.client, {}), ['Primary'])
+
+    def test_unhealthy_replica_falls_back_to_primary(self):
+        self.app.config['SQLALCHEMY_REPLICA_URIS'] = [
+            f'sqlite:///{os.path.join(self.tmp.name, "missing", "x.db")}']
+        Movie(title='Primary').insert()
+
+        res = self.client.get(f'{API_PREFIX}/movies',
+                              headers={"ROLE": "CASTING_ASSISTANT"})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([m['title'] for m in data['movies']], ['Primary'])
+
+    def test_dispose_engines(self):
+        self.client.get(f'{API_PREFIX}/movies',
+                        headers={"ROLE": "CASTING_ASSISTANT"})
+        replica = self.app.extensions['replicas'].engines[0]
+
+        with patch.object(db.engine, 'dispose') as primary_dispose, \
+                patch.object(replica, 'dispose') as replica_dispose:
+            dispose_engines(self.app)
+
+        primary_dispose.assert_called_once_with()
+        replica_dispose.assert_called_once_with()
+
+
+class SQLiteProfileTestCase(unittest.TestCase):
+    """This class runs the API with the single node SQLite profile"""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        uri = f'sqlite:///{os.path.join(self.tmp.name, "casting.db")}'
+
+        self.app = create_app('testing')
+        self.app.config.update(
+            SQLALCHEMY_DATABASE_URI=uri,
+            SQLALCHEMY_REPLICA_URIS=[uri],
+            SQLALCHEMY_ENGINE_OPTIONS=SQLiteConfig.SQLALCHEMY_ENGINE_OPTIONS,
+            REPLICA_ENGINE_OPTIONS=SQLiteConfig.REPLICA_ENGINE_OPTIONS,
+            REPLICA_READS='all',
+            SQLITE_PRAGMAS=SQLiteConfig.SQLITE_PRAGMAS)
+        self.client = self.app.test_client()
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        dispose_engines(self.app)
+        self.app_context.pop()
+        self.tmp.cleanup()
+
+    def test_sqlite_pragmas(self):
+        reader = self.app.extensions['replicas'].pick()
+
+        with db.engine.connect() as connection:
+            self.assertEqual(connection.scalar('PRAGMA journal_mode'), 'wal')
+            self.assertEqual(connection.scalar('PRAGMA foreign_keys'), 1)
+            self.assertEqual(connection.scalar('PRAGMA query_only'), 0)
+
+        with reader.connect() as connection:
+            self.assertEqual(connection.scalar('PRAGMA query_only'), 1)
+
+    def test_reads_use_reader_until_write(self):
+        statement = Movie.__table__.select()
+        reader = self.app.extensions['replicas'].pick()
+
+        self.assertIs(db.session.get_bind(clause=statement), reader)
+
+        db.session.add(Movie(title='Written', version=1))
+        db.session.flush()
+
+        self.assertIs(db.session.get_bind(clause=statement), db.engine)
+        db.session.commit()
+        self.assertIs(db.session.get_bind(clause=statement), reader)
+
+    def test_export_job_with_one_writer(self):
+        Actor(name='Test').insert()
+
+        res = self.client.post(f'{API_PREFIX}/actors/jobs', json={
+            'operation': 'export',
+            'format': 'ndjson'
+        }, headers={"ROLE": "CASTING_ASSISTANT"})
+        data = json.loads(res.data)
+
+        self.assertEqual(data['job']['status'], 'succeeded')
+
+
+class CastIndexTestCase(unittest.TestCase):
+    """The co-star index built in the background, on a file database the
+    builder thread can see"""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.app = create_app('testing')
+        self.app.config['SQLALCHEMY_DATABASE_URI'] = \
+            f'sqlite:///{os.path.join(self.tmp.name, "casting.db")}'
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.index = CastIndex(self.app, 1)
+
+        self.actors = [Actor(name=name) for name in ('A', 'B', 'C')]
+        for actor in self.actors:
+            actor.insert()
+
+        self.movies = [Movie(title='First', actors=self.actors[0:2]),
+                       Movie(title='Second', actors=self.actors[1:2])]
+        for movie in self.movies:
+            movie.insert()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        self.tmp.cleanup()
+
+    def build(self):
+        builder = self.index.builder
+        self.assertIsNotNone(builder)
+        builder.join()
+        self.assertIsNone(self.index.builder)
+
+    def test_answers_with_sql_until_built(self):
+        self.assertEqual(self.index.costars(self.actors[1].id),
+                         [self.actors[0].id])
+        self.assertIsNone(self.index.snapshot)
+
+        self.build()
+
+        self.assertIsNotNone(self.index.snapshot)
+        self.assertEqual(self.index.costars(self.actors[1].id),
+                         [self.actors[0].id])
+
+    def test_rebuild_keeps_serving_current_snapshot(self):
+        a, b, c = (actor.id for actor in self.actors)
+        self.index.costars(a)
+        self.build()
+        snapshot = self.index.snapshot
+
+        self.movies[0].actors.append(self.actors[2])
+        self.movies[0].update()
+        self.movies[1].actors.append(self.actors[2])
+        self.movies[1].update()
+
+        # the builder swaps the snapshot under the lock, holding it keeps
+        # the rebuild from finishing
+        with self.index.lock:
+            # one change per sync, the second grows the overlay past 1
+            self.assertEqual(self.index.costars(a), [b, c])
+            self.assertIsNone(self.index.builder)
+            self.assertEqual(self.index.costars(b), [a, c])
+            self.assertIsNotNone(self.index.builder)
+            self.assertIs(self.index.snapshot, snapshot)
+            self.assertEqual(self.index.shortest_path(a, c), ([a, c], [
+                self.movies[0].id]))
+
+        self.build()
+
+        self.assertIsNot(self.index.snapshot, snapshot)
+        self.assertEqual(self.index.snapshot.casts, {})
+        self.assertEqual(self.index.costars(c), [a, b])
+
+    def test_only_cast_changes_count(self):
+        self.index.costars(self.actors[0].id)
+        self.build()
+
+        for actor in self.actors:
+            actor.name = 'Renamed'
+            actor.update()
+        Actor(name='D').insert()
+
+        self.assertEqual(self.index.costars(self.actors[0].id),
+                         [self.actors[1].id])
+        self.assertIsNone(self.index.builder)
+        self.assertEqual(self.index.snapshot.cursor,
+                         db.session.query(db.func.max(Change.id)).scalar())
+
+        delete_rows(Actor, [self.actors[1].id])
+        db.session.commit()
+
+        # the delete recasts both movies of the actor
+        self.assertEqual(self.index.costars(self.actors[0].id), [])
+        self.build()
+        self.assertEqual(self.index.costars(self.actors[0].id), [])
+
+
+class AccessLogTestCase(unittest.TestCase):
+    """This class represents the access log test case"""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'access.log')
+
+        with patch.multiple(TestingConfig, ACCESS_LOG_ENABLED=True,
+                            ACCESS_LOG_FILE=self.path,
+                            ACCESS_LOG_SAMPLING={'api.get_actors': 0}):
+            self.app = create_app('testing')
+
+        self.client = self.app.test_client()
+        self.handler = self.app.extensions['access_log'].handler
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app.logger.removeHandler(self.handler)
+        self.handler.close()
+        self.app_context.pop()
+        self.tmp.cleanup()
+
+    def entries(self):
+        # stopping the listener writes everything still queued
+        self.handler.close()
+
+        with open(self.path) as log:
+            return [json.loads(line) for line in log]
+
+    def test_access_log(self):
+        Movie(title='Test').insert()
+        Actor(name='Test').insert()
+
+        self.client.get(f'{API_PREFIX}/movies', headers={
+            "ROLE": "CASTING_ASSISTANT", "SUB": "auth0|1"})
+        self.client.get(f'{API_PREFIX}/actors',
+                        headers={"ROLE": "CASTING_ASSISTANT"})
+        self.app.logger.error('Failed')
+
+        access, error = self.entries()
+
+        self.assertEqual(access['route'], '/api/v1/movies')
+        self.assertEqual(access['method'], 'GET')
+        self.assertEqual(access['status'], 200)
+        self.assertEqual(access['subject'], 'auth0|1')
+        self.assertGreater(access['queries'], 0)
+        self.assertEqual(access['sample_rate'], 1)
+        self.assertIn('latency_ms', access)
+        self.assertEqual(error['level'], 'ERROR')
+        self.assertEqual(error['message'], 'Failed')
+
+    def test_access_log_keeps_slow_requests(self):
+        Actor(name='Test').insert()
+        self.app.extensions['access_log'].slow = 0
+
+        self.client.get(f'{API_PREFIX}/actors',
+                        headers={"ROLE": "CASTING_ASSISTANT"})
+
+        self.assertEqual([e['route'] for e in self.entries()],
+                         ['/api/v1/actors'])
+
+    def test_access_log_keeps_errors(self):
+        self.client.get(f'{API_PREFIX}/actors',
+                        headers={"ROLE": "CASTING_ASSISTANT"})
+
+        self.assertEqual([e['status'] for e in self.entries()], [404])
+
+
+def mock_decode_jwt(token, jwks):
+    return {"permissions": ROLES[token]["permissions"]}
+
+
+class AsyncServingTestCase(unittest.TestCase):
+    """This class represents the async serving mode test case"""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.app = create_app('testing')
+        self.app.config['SQLALCHEMY_DATABASE_URI'] = \
+            f'sqlite:///{os.path.join(self.tmp.name, "casting.db")}'
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+        self.asgi = AsyncApp(self.app)
+        self.signing_keys = SigningKeys()
+        self.signing_keys.jwks = {}
+        self.signing_keys.expires = float('inf')
+        self.keys = patch('app.auth.signing_keys', self.signing_keys)
+        self.keys.start()
+        self.decode = patch('app.asgi.decode_jwt', mock_decode_jwt)
+        self.decode.start()
+
+    def tearDown(self):
+        self.decode.stop()
+        self.keys.stop()
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        self.tmp.cleanup()
+
+    def request(self, method, path, headers={}, body=None):
+        """Runs one request through the ASGI app"""
+        async def run():
+            messages = []
+            content = json.dumps(body).encode() if body is not None else b''
+            path_only, _, query = path.partition('?')
+            scope = {
+                'type': 'http',
+                'asgi': {'version': '3.0'},
+                'http_version': '1.1',
+                'method': method,
+                'scheme': 'http',
+                'path': path_only,
+                'raw_path': path_only.encode(),
+                'query_string': query.encode(),
+                'root_path': '',
+                'headers': [(k.lower().encode(), v.encode())
+                            for k, v in headers.items()] +
+                [(b'content-type', b'application/json'),
+                 (b'content-length', str(len(content)).encode())],
+                'server': ('localhost', 80),
+                'client': ('127.0.0.1', 5000)
+            }
+
+            async def receive():
+                return {'type': 'http.request', 'body': content,
+                        'more_body': False}
+
+            async def send(message):
+                messages.append(message)
+
+            try:
+                await self.asgi(scope, receive, send)
+            finally:
+                if self.asgi.database.is_connected:
+                    await self.asgi.database.disconnect()
+                self.asgi.connecting = None
+
+            status = messages[0]['status']
+            data = b''.join(m.get('body', b'') for m in messages[1:])
+
+            if (b'content-encoding', b'gzip') in messages[0]['headers']:
+                data = gzip.decompress(data)
+
+            return status, json.loads(data)
+
+        return asyncio.run(run())
+
+    def test_async_get_movies(self):
+        actor = Actor(name='Test')
+        actor.insert()
+        movie = Movie(title='Test', release_date=datetime(2012, 12, 4),
+                      actors=[actor])
+        movie.insert()
+        expected = json.loads(self.app.test_client().get(
+            f'{API_PREFIX}/movies?page=1',
+            headers={"ROLE": "CASTING_ASSISTANT"}).data)
+
+        status, data = self.request(
+            'GET', f'{API_PREFIX}/movies?page=1',
+            headers={'Authorization': 'Bearer CASTING_ASSISTANT'})
+
+        self.assertEqual(status, 200)
+        self.assertEqual(data, expected)
+
+    def test_async_get_movies_gzip(self):
+        for i in range(50):
+            Movie(title=f'Title {i}').insert()
+        expected = json.loads(self.app.test_client().get(
+            f'{API_PREFIX}/movies',
+            headers={"ROLE": "CASTING_ASSISTANT"}).data)
+
+        status, data = self.request(
+            'GET', f'{API_PREFIX}/movies',
+            headers={'Authorization': 'Bearer CASTING_ASSISTANT',
+                     'Accept-Encoding': 'gzip'})
+
+        self.assertEqual(status, 200)
+        self.assertEqual(data, expected)
+        self.assertEqual(len(self.app.extensions['compression'].cache), 1)
+
+    def test_async_get_actors_404(self):
+        status, data = self.request(
+            'GET', f'{API_PREFIX}/actors',
+            headers={'Authorization': 'Bearer CASTING_ASSISTANT'})
+
+        self.assertEqual(status, 404)
+        self.assertEqual(data['message'], "Resource was not found")
+
+    def test_async_get_actors_401(self):
+        status, data = self.request('GET', f'{API_PREFIX}/actors')
+
+        self.assertEqual(status, 401)
+        self.assertEqual(data['message'], "Authorization header is expected")
+
+    def test_async_get_movies_500(self):
+        with patch.object(self.asgi.database, 'fetch_all',
+                          side_effect=RuntimeError('connection lost')):
+            status, data = self.request(
+                'GET', f'{API_PREFIX}/movies',
+                headers={'Authorization': 'Bearer CASTING_ASSISTANT'})
+
+        self.assertEqual(status, 500)
+        self.assertEqual(data, {"success": False, "error": 500,
+                                "message": "Internal Server error"})
+
+    def test_async_fetches_signing_keys_once(self):
+        Movie(title='Test').insert()
+        self.signing_keys.expires = 0
+
+        with patch('app.auth.fetch_jwks', return_value={}) as fetch:
+            for _ in range(2):
+                status, _ = self.request(
+                    'GET', f'{API_PREFIX}/movies',
+                    headers={'Authorization': 'Bearer CASTING_ASSISTANT'})
+
+                self.assertEqual(status, 200)
+
+        fetch.assert_called_once_with()
+
+    def test_async_falls_back_to_flask(self):
+        status, data = self.request('POST', f'{API_PREFIX}/actors',
+                                    headers={"ROLE": "EXECUTIVE_PRODUCER"},
+                                    body={'name': 'Name'})
+
+        self.assertEqual(status, 200)
+        self.assertEqual(data['actor']['name'], 'Name')
+
 
 if __name__ == "__main__":
     unittest.main()
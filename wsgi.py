@@ -0,0 +1,6 @@
+import os
+
+from app import create_app
+
+# serving entry point, migrations and management commands live in casting.py
+app = create_app(os.getenv('FLASK_ENV') or 'default')